@@ -0,0 +1,44 @@
+"""
+Benchmark of the single-pass analysis engine.
+
+Runs `analyse_bia` on synthetic study/image documents of increasing size and prints the time per study,
+which should stay flat (linear scaling).
+
+    poetry run python -m benchmarks.bench_analysis --sizes 1000 2000 4000 8000
+"""
+
+import argparse
+import logging
+import time
+from benchmarks.synthetic import generate_archive
+from bia_study_tracker.utils.analysis import analyse_bia
+from bia_study_tracker.utils.records import ImageRecord, StudyRecord
+from bia_study_tracker.utils.reports import build_image_lookup
+
+
+def make_studies_and_images(n_studies: int, images_per_study: int, seed: int = 0) -> tuple[list[StudyRecord], list[ImageRecord]]:
+    archive = generate_archive(n_studies, images_per_study, seed=seed)
+    return ([StudyRecord.from_document(study) for study in archive.studies],
+            [ImageRecord.from_document(image) for image in archive.images])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 2000, 4000, 8000])
+    parser.add_argument("--images-per-study", type=int, default=20)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    print(f"{'studies':>8} {'images':>8} {'time (s)':>9} {'us/study':>9}")
+    for size in args.sizes:
+        studies, images = make_studies_and_images(size, args.images_per_study)
+        image_lookup = build_image_lookup(images)
+        biostudies = [f"S-BIAD{i}" for i in range(0, size + size // 10)]
+        start = time.perf_counter()
+        analyse_bia(studies, image_lookup, biostudies)
+        elapsed = time.perf_counter() - start
+        print(f"{size:>8} {len(images):>8} {elapsed:>9.3f} {elapsed / size * 1e6:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
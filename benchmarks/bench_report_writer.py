@@ -0,0 +1,55 @@
+"""
+Benchmark of the streaming detailed report writer against the pandas one.
+
+Writes the detailed report file of synthetic archives of increasing size with both writers and prints the write
+time and the peak memory allocated while writing, which should stay flat per study for the streaming writer.
+
+    poetry run python -m benchmarks.bench_report_writer --sizes 1000 2000 4000 8000
+"""
+
+import argparse
+import logging
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from benchmarks.bench_analysis import make_studies_and_images
+from bia_study_tracker.utils.analysis import analyse_bia
+from bia_study_tracker.utils.biostudies import FileListing
+from bia_study_tracker.utils.reports import (
+    build_image_lookup,
+    write_detailed_report_streaming,
+    write_detailed_report_with_pandas,
+)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 2000, 4000, 8000])
+    parser.add_argument("--images-per-study", type=int, default=20)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    print(f"{'studies':>8} {'writer':>10} {'time (s)':>9} {'peak (MB)':>10} {'KB/study':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            studies, images = make_studies_and_images(size, args.images_per_study)
+            analysis = analyse_bia(studies, build_image_lookup(images), (f"S-BIAD{i}" for i in range(size)))
+            report = analysis.report.to_dict() | {"summary_stats": analysis.report.get_summary_statistics(),
+                                                  "summary_cols": ["Statistic", "Value"]}
+            file_listings = {acc: FileListing(5, "tif, png") for acc in
+                             [*report["image"]["studies_without"], *report["dataset"]["studies_without"]]}
+            for name, write in (("pandas", write_detailed_report_with_pandas),
+                                ("streaming", write_detailed_report_streaming)):
+                tracemalloc.start()
+                start = time.perf_counter()
+                write(analysis.accession_lookup, report, analysis.conversion_report, Path(tmp) / f"{name}.xlsx",
+                      file_listings)
+                elapsed = time.perf_counter() - start
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                print(f"{size:>8} {name:>10} {elapsed:>9.3f} {peak / 2**20:>10.1f} {peak / 2**10 / size:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
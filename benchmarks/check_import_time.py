@@ -0,0 +1,92 @@
+"""
+Startup budget check: the CLI and the lightweight commands must import quickly and without the reporting stack.
+
+Each entry point is imported in a fresh interpreter. The best of `--repeat` runs, minus the time of an empty
+interpreter, is compared to its budget, and the heavy modules it must not load are checked in `sys.modules`.
+Exits with status 1 on any regression, printing the slowest imports from `python -X importtime`.
+
+    poetry run python -m benchmarks.check_import_time
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+from dataclasses import dataclass
+
+HEAVY_MODULES = ["pandas", "ngff_zarr", "zarr", "dask", "slack_sdk", "aiohttp"]
+
+
+@dataclass
+class EntryPoint:
+    name: str
+    modules: list[str]
+    budget: float
+    # Heavy modules this entry point is allowed to load
+    allowed: tuple[str, ...] = ()
+
+
+ENTRY_POINTS = [
+    EntryPoint("cli", ["bia_study_tracker.main"], 0.3),
+    EntryPoint("check-mongo-elastic-sync",
+               ["bia_study_tracker.main", "bia_study_tracker.study_tracker", "bia_study_tracker.utils.slack_bot"],
+               0.8, allowed=("slack_sdk",)),
+    EntryPoint("status", ["bia_study_tracker.main", "bia_study_tracker.status_server"], 0.5),
+]
+
+
+def _run(code: str, *flags: str) -> tuple[float, subprocess.CompletedProcess]:
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, *flags, "-c", code], capture_output=True, text=True, check=True)
+    return time.perf_counter() - start, process
+
+
+def _import_code(modules: list[str]) -> str:
+    return f"import sys, json; import {', '.join(modules)}; " \
+           f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"
+
+
+def _slowest_imports(modules: list[str], n: int = 10) -> list[str]:
+    _, process = _run(_import_code(modules), "-X", "importtime")
+    lines = [line for line in process.stderr.splitlines() if line.startswith("import time:") and "|" in line]
+    rows = []
+    for line in lines:
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            rows.append((int(cumulative), name.rstrip()))
+    return [f"{cumulative / 1e6:8.3f}s {name}" for cumulative, name in sorted(rows, reverse=True)[:n]]
+
+
+def check(entry_point: EntryPoint, baseline: float, repeat: int) -> bool:
+    timings, loaded = [], []
+    for _ in range(repeat):
+        elapsed, process = _run(_import_code(entry_point.modules))
+        timings.append(elapsed - baseline)
+        loaded = json.loads(process.stdout)
+    best = max(0.0, min(timings))
+    forbidden = [module for module in loaded if module not in entry_point.allowed]
+    ok = best <= entry_point.budget and not forbidden
+    print(f"{'ok' if ok else 'FAIL':4} {entry_point.name:28} {best:6.3f}s (budget {entry_point.budget:.1f}s)"
+          + (f" loads {', '.join(forbidden)}" if forbidden else ""))
+    if not ok:
+        print("\n".join(f"       {line}" for line in _slowest_imports(entry_point.modules)))
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiply every budget, e.g. on slow CI runners")
+    args = parser.parse_args()
+
+    baseline = min(_run("pass")[0] for _ in range(args.repeat))
+    results = []
+    for entry_point in ENTRY_POINTS:
+        entry_point.budget *= args.scale
+        results.append(check(entry_point, baseline, args.repeat))
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Offline end-to-end benchmark of the tracker against a local stand-in of the BIA and BioStudies APIs.
+
+Generates a synthetic archive, serves it with `benchmarks.stub_server` and times each stage of the
+report and sync commands. Results are written as JSON so they can be compared between versions.
+
+    poetry run python -m benchmarks.run_benchmarks --studies 2000 --latency-ms 20 --output bench.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from importlib import metadata
+from pathlib import Path
+from benchmarks.stub_server import StubServer
+from benchmarks.synthetic import generate_archive
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def _version() -> str:
+    try:
+        return metadata.version("bia-study-tracker")
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def run(args: argparse.Namespace) -> dict:
+    archive = generate_archive(args.studies, args.images_per_study, args.representations_per_image, args.seed)
+    server = StubServer(archive, latency=args.latency_ms / 1000, error_rate=args.error_rate, seed=args.seed)
+    server.start()
+    workdir = Path(tempfile.mkdtemp(prefix="bia-tracker-bench-"))
+
+    # Settings are read from the environment, so this must happen before the tracker modules are imported
+    os.environ.update({
+        "PUBLIC_SEARCH_API": f"{server.url}/search",
+        "PUBLIC_MONGO_API": f"{server.url}/mongo",
+        "BIOSTUDIES_API": f"{server.url}/biostudies",
+        "PUBLIC_WEBSITE_URL": "https://example.org/study",
+        "CACHE_DIR": str(workdir / "cache"),
+        "MAX_CONCURRENT_REQUESTS": str(args.concurrency),
+        "BACKOFF_BASE": "0.01",
+        "RETRY_BUDGET": "100000",
+        "VALIDATION_FLAG": "false",
+        "VALIDATION_TIER": "",
+    })
+    from bia_study_tracker.study_tracker import BIAStudyTracker
+    from bia_study_tracker.utils.analysis import analyse_bia
+    from bia_study_tracker.utils.metrics import get_metrics
+    from bia_study_tracker.utils.reports import generate_detailed_report_file
+    from bia_study_tracker.utils.slack_bot import build_message, format_slack_message
+
+    stages: dict[str, float] = {}
+
+    @contextmanager
+    def stage(name: str):
+        start = time.perf_counter()
+        yield
+        stages[name] = round(time.perf_counter() - start, 4)
+
+    tracker = BIAStudyTracker()
+
+    with stage("fetch_biostudies"):
+        tracker.studies_in_biostudies
+    with stage("fetch_biostudies_incremental"):
+        BIAStudyTracker().studies_in_biostudies
+    with stage("fetch_studies"):
+        studies = tracker.studies_in_bia
+    with stage("fetch_images"):
+        images = tracker.images_in_bia
+    with stage("fetch_mongo"):
+        tracker.studies_in_mongo
+    with stage("analyse_bia"):
+        analysis = analyse_bia(studies, images, (study.accession for study in tracker.studies_in_biostudies))
+    report_dict = analysis.report.to_dict() | {"summary_stats": analysis.report.get_summary_statistics(),
+                                               "summary_cols": ["Statistic", "Value"]}
+    with stage("generate_detailed_report_file"):
+        _, summary = generate_detailed_report_file(analysis.accession_lookup, report_dict, analysis.conversion_report,
+                                                   workdir / "detailed_report.xlsx")
+    with stage("slack_formatting"):
+        build_message(format_slack_message(summary, report_dict["summary_cols"]))
+    with stage("check_mongo_elastic_sync"):
+        tracker.check_mongo_elastic_sync()
+    server.shutdown()
+
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "version": _version(),
+        "git_commit": _git_commit(),
+        "python": platform.python_version(),
+        "parameters": {
+            "studies": args.studies,
+            "images": len(archive.images),
+            "images_per_study": args.images_per_study,
+            "representations_per_image": args.representations_per_image,
+            "latency_ms": args.latency_ms,
+            "error_rate": args.error_rate,
+            "concurrency": args.concurrency,
+            "seed": args.seed,
+        },
+        "http": {"requests": server.request_count, "injected_errors": server.error_count},
+        "stages_seconds": stages,
+        "tracker_metrics": get_metrics().to_dict(),
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--studies", type=int, default=1000)
+    parser.add_argument("--images-per-study", type=int, default=10)
+    parser.add_argument("--representations-per-image", type=int, default=2)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, help="Write the JSON results here instead of stdout")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    results = json.dumps(run(args), indent=2)
+    if args.output:
+        args.output.write_text(results + "\n")
+    else:
+        sys.stdout.write(results + "\n")
+
+
+if __name__ == "__main__":
+    main()
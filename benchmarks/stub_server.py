@@ -0,0 +1,146 @@
+"""
+Local stand-in for the BIA search, BIA Mongo and BioStudies APIs, serving a synthetic archive.
+
+    search:     /search/search/fts?query=&pagination.page=&pagination.page_size=
+                /search/search/fts/image?query=&pagination.page=&pagination.page_size=
+    mongo:      /mongo/search/study?page_size=&start_from_uuid=
+    biostudies: /biostudies/files/<accession>
+                /biostudies/BioImages/search?pageSize=&page=&sortBy=release_date&sortOrder=descending
+
+Every request waits `latency` seconds, and fails with a 503 (Retry-After: 0) with probability `error_rate`.
+
+    poetry run python -m benchmarks.stub_server --studies 2000 --latency-ms 50 --error-rate 0.01
+"""
+
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from benchmarks.synthetic import SyntheticArchive, generate_archive
+
+
+def _search_page(documents: list[dict], query: dict[str, list[str]]) -> dict:
+    page_size = int(query.get("pagination.page_size", ["10"])[0])
+    page = int(query.get("pagination.page", ["1"])[0])
+    hits = documents[(page - 1) * page_size: page * page_size]
+    return {
+        "hits": {"total": {"value": len(documents)}, "hits": [{"_source": document} for document in hits]},
+        "pagination": {"page": page, "page_size": page_size, "total_pages": max(1, math.ceil(len(documents) / page_size))},
+    }
+
+
+def _biostudies_search_page(studies: list[dict], query: dict[str, list[str]]) -> dict:
+    page_size = int(query.get("pageSize", ["20"])[0])
+    page = int(query.get("page", ["1"])[0])
+    if query.get("sortBy") == ["release_date"]:
+        studies = sorted(studies, key=lambda study: study["release_date"], reverse=query.get("sortOrder") != ["ascending"])
+    hits = studies[(page - 1) * page_size: page * page_size]
+    return {"page": page, "pageSize": page_size, "totalHits": len(studies), "isTotalHitsExact": True,
+            "hits": [{"type": "study", **study} for study in hits]}
+
+
+def _mongo_page(documents: list[dict], query: dict[str, list[str]]) -> list[dict]:
+    page_size = int(query.get("page_size", ["10"])[0])
+    cursor = query.get("start_from_uuid", [None])[0]
+    if cursor:
+        documents = [document for document in documents if document["uuid"] >= cursor]
+    return documents[:page_size]
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, archive: SyntheticArchive, port: int = 0, latency: float = 0.0, error_rate: float = 0.0,
+                 seed: int = 0) -> None:
+        super().__init__(("127.0.0.1", port), StubRequestHandler)
+        self.archive = archive
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.request_count = 0
+        self.error_count = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def should_fail(self) -> bool:
+        with self._lock:
+            self.request_count += 1
+            fail = self.random.random() < self.error_rate
+            self.error_count += fail
+            return fail
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    server: StubServer
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def _send(self, status: int, body=None, headers: dict[str, str] | None = None) -> None:
+        payload = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _route(self, path: str, query: dict[str, list[str]]):
+        archive = self.server.archive
+        if path == "/search/search/fts":
+            return _search_page(archive.studies, query)
+        if path == "/search/search/fts/image":
+            return _search_page(archive.images, query)
+        if path == "/mongo/search/study":
+            return _mongo_page(archive.mongo_studies, query)
+        if path.startswith("/biostudies/files/"):
+            return archive.biostudies_files.get(path.rsplit("/", 1)[-1])
+        if path == "/biostudies/BioImages/search":
+            return _biostudies_search_page(archive.biostudies_studies, query)
+        return None
+
+    def do_GET(self) -> None:
+        time.sleep(self.server.latency)
+        if self.server.should_fail():
+            return self._send(503, {"error": "injected failure"}, {"Retry-After": "0"})
+        url = urlparse(self.path)
+        body = self._route(url.path, parse_qs(url.query, keep_blank_values=True))
+        if body is None:
+            return self._send(404, {"error": "not found"})
+        self._send(200, body)
+
+    def do_HEAD(self) -> None:
+        self._send(404)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--studies", type=int, default=1000)
+    parser.add_argument("--images-per-study", type=int, default=10)
+    parser.add_argument("--representations-per-image", type=int, default=2)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    archive = generate_archive(args.studies, args.images_per_study, args.representations_per_image)
+    server = StubServer(archive, args.port, args.latency_ms / 1000, args.error_rate)
+    print(f"Serving {len(archive.studies)} studies and {len(archive.images)} images on {server.url}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
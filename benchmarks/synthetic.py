@@ -0,0 +1,89 @@
+"""
+Synthetic BIA data in the shape returned by the search, Mongo and BioStudies APIs.
+"""
+
+import random
+from dataclasses import dataclass
+from typing import Any
+
+
+@dataclass
+class SyntheticArchive:
+    # Raw `_source` documents of the search indexes
+    studies: list[dict[str, Any]]
+    images: list[dict[str, Any]]
+    # Documents of the Mongo `search/study` endpoint
+    mongo_studies: list[dict[str, Any]]
+    # accession -> BioStudies `files/{accession}` response
+    biostudies_files: dict[str, dict[str, Any]]
+    # BioStudies BioImages search hits
+    biostudies_studies: list[dict[str, Any]]
+
+
+def generate_archive(
+    n_studies: int,
+    images_per_study: int = 10,
+    representations_per_image: int = 2,
+    seed: int = 0,
+) -> SyntheticArchive:
+    """Generate a deterministic archive of `n_studies` studies.
+
+    About 10% of studies have no datasets and 20% have datasets without images. Every image has
+    `representations_per_image` representations, the first of which is usually an OME-Zarr. Mongo is
+    missing about 1% of the studies and BioStudies has 10% more studies than BIA.
+    """
+    rng = random.Random(seed)
+    studies, images, mongo_studies, biostudies_studies = [], [], [], []
+    biostudies_files = {}
+    for i in range(n_studies):
+        accession_id = f"S-BIAD{i}"
+        release_date = f"20{20 + i % 5}-{1 + i % 12:02d}-{1 + i % 28:02d}"
+        datasets, study_images = [], []
+        if rng.random() > 0.1:
+            n_images = images_per_study if rng.random() > 0.2 else 0
+            image_uuids = [f"{accession_id}-image-{j}" for j in range(n_images)]
+            datasets.append({
+                "uuid": f"{accession_id}-dataset",
+                "image_count": n_images,
+                "example_image_uri": [f"https://example.org/{accession_id}/static.png"] if rng.random() > 0.3 else [],
+                "image": [{"uuid": uuid} for uuid in image_uuids],
+            })
+            for uuid in image_uuids:
+                representations = [
+                    {
+                        "uuid": f"{uuid}-rep-{k}",
+                        "image_format": ".ome.zarr" if k == 0 and rng.random() > 0.1 else ".tif",
+                        "file_uri": [f"https://example.org/{uuid}/{k}.ome.zarr"],
+                        "total_size_in_bytes": rng.randint(10**6, 10**9),
+                    }
+                    for k in range(representations_per_image)
+                ] if rng.random() > 0.05 else []
+                study_images.append({
+                    "uuid": uuid,
+                    "version": 1,
+                    "additional_metadata": [
+                        {"name": "image_thumbnail_uri", "value": {"256": {"uri": f"https://example.org/{uuid}.png"}}}
+                    ] if rng.random() > 0.2 else [],
+                    "representation": representations,
+                })
+        study = {
+            "accession_id": accession_id,
+            "uuid": f"{accession_id}-uuid",
+            "title": f"Synthetic study {i}",
+            "release_date": release_date,
+            "version": 1,
+            "description": "A synthetic study " * 20,
+            "dataset": datasets,
+        }
+        studies.append(study)
+        images.extend(study_images)
+        if rng.random() > 0.01:
+            mongo_studies.append({key: study[key] for key in ["accession_id", "uuid", "title", "release_date", "version"]})
+        biostudies_files[accession_id] = {
+            "recordsTotal": rng.randint(0, 500),
+            "data": [{"type": "file", "Name": f"file{j}.{rng.choice(['tif', 'czi', 'png'])}"} for j in range(5)],
+        }
+    for i in range(n_studies + n_studies // 10):
+        biostudies_studies.append({"accession": f"S-BIAD{i}", "release_date": f"20{20 + i % 5}-{1 + i % 12:02d}-{1 + i % 28:02d}"})
+    mongo_studies.sort(key=lambda study: study["uuid"])
+    return SyntheticArchive(studies, images, mongo_studies, biostudies_files, biostudies_studies)
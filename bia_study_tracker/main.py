@@ -1,6 +1,6 @@
 import typer
-from bia_study_tracker.study_tracker import BIAStudyTracker
-from bia_study_tracker.utils.slack_bot import SlackReportBot
+from pathlib import Path
+from typing import Optional
 import logging
 
 # Configure logging
@@ -9,27 +9,129 @@ logger = logging.getLogger(__name__)
 
 app = typer.Typer(help="Study tracker: Tracks ingested studies and creates a report.")
 
+
+# The tracker, reporting and Slack modules are imported inside the commands that use them, so that
+# `--help` and the lightweight commands don't pay for the whole dependency stack at startup.
+
+def write_metrics() -> None:
+    from bia_study_tracker.settings import get_settings
+    from bia_study_tracker.utils.metrics import get_metrics
+
+    metrics_file = get_settings().metrics_file
+    if metrics_file:
+        try:
+            get_metrics().write(Path(metrics_file))
+        except OSError as e:
+            logger.error(f"Could not write run metrics to {metrics_file}: {e}")
+
+
 @app.command()
-def generate_report():
+def generate_report(
+    full_refresh: bool = typer.Option(False, "--full-refresh", help="Refetch the whole BioStudies study list and recompute "
+                                                                           "every conversion report entry."),
+    shard: Optional[str] = typer.Option(None, "--shard", help="Only process shard i of n (e.g. 2/4) and save its result "
+                                                              "to --shard-dir for merge-reports, instead of posting."),
+    shard_dir: Path = typer.Option(Path("shards"), "--shard-dir", help="Directory the shard result is saved to."),
+    resume: bool = typer.Option(False, "--resume", help="Continue the last interrupted run from its checkpoint "
+                                                        "instead of starting over."),
+):
+    from bia_study_tracker.study_tracker import BIAStudyTracker
+    from bia_study_tracker.utils.sharding import Shard
+    from bia_study_tracker.utils.slack_bot import SlackReportBot
+
     try:
-        tracker = BIAStudyTracker()
-        report, path = tracker.generate_report()
+        selected_shard = Shard.parse(shard) if shard else None
+    except ValueError as e:
+        raise typer.BadParameter(str(e), param_hint="--shard")
+    try:
+        tracker = BIAStudyTracker(full_refresh=full_refresh, shard=selected_shard)
+        if selected_shard:
+            tracker.generate_shard_report(shard_dir, resume)
+            return
+        report, path = tracker.generate_report(resume)
         bot = SlackReportBot()
         bot.run(data=report, file_path=str(path))
 
     except Exception as e:
         logger.error(f"Application error: {e}")
+        logger.error("Fetched pages, conversion results and validation outcomes are checkpointed, "
+                     "rerun with --resume to continue from them.")
+        # Fail the job, so that re-running it resumes from the checkpoint
+        raise typer.Exit(1)
+    finally:
+        write_metrics()
+
+
+@app.command()
+def merge_reports(
+    paths: list[Path] = typer.Argument(..., help="Shard result files, or directories containing them."),
+):
+    """Combine the results of every `generate-report --shard i/n` run into one report and post it."""
+    from bia_study_tracker.study_tracker import merge_shard_reports
+    from bia_study_tracker.utils.slack_bot import SlackReportBot
+
+    try:
+        report, path = merge_shard_reports(paths)
+        bot = SlackReportBot()
+        bot.run(data=report, file_path=str(path))
+    except Exception as e:
+        logger.error(f"Application error: {e}")
+        # Fail the job, e.g. when a shard is missing
+        raise typer.Exit(1)
+    finally:
+        write_metrics()
 
 
 @app.command()
 def check_mongo_elastic_sync():
+    from bia_study_tracker.study_tracker import BIAStudyTracker
+    from bia_study_tracker.utils.slack_bot import SlackReportBot
+
     try:
         tracker = BIAStudyTracker()
         report = tracker.check_mongo_elastic_sync()
         bot = SlackReportBot()
-        bot.send_message(report)
+        bot.send_message(bot.add_performance_table(report))
     except Exception as ex:
         logger.error(f"Application error: {ex}")
+        # Fail the job, e.g. when a page of either study list couldn't be fetched
+        raise typer.Exit(1)
+    finally:
+        write_metrics()
+
+@app.command()
+def serve(
+    port: Optional[int] = typer.Option(None, "--port", help="Local port to serve on (default STATUS_PORT)."),
+    refresh_minutes: Optional[float] = typer.Option(None, "--refresh-minutes",
+                                                    help="Minutes between index refreshes (default STATUS_REFRESH_MINUTES)."),
+):
+    """Keep an in-memory status index of every study, refreshed on a timer, and serve it at /status/<accession>."""
+    from bia_study_tracker.settings import get_settings
+    from bia_study_tracker.status_server import serve as serve_status
+
+    settings = get_settings()
+    try:
+        serve_status(port or settings.status_port, refresh_minutes or settings.status_refresh_minutes, write_metrics)
+    except KeyboardInterrupt:
+        logger.info("Status server stopped")
+
+
+@app.command()
+def status(
+    accession_id: str = typer.Argument(..., help="Study accession, e.g. S-BIAD1234."),
+    url: Optional[str] = typer.Option(None, "--url", help="Status server to ask (default http://127.0.0.1:STATUS_PORT)."),
+):
+    """Print the status of one study from the `serve` index, or from the index it last saved if it isn't running."""
+    import json
+    from bia_study_tracker.settings import get_settings
+    from bia_study_tracker.status_server import lookup_status
+
+    study_status, source = lookup_status(accession_id, url or f"http://127.0.0.1:{get_settings().status_port}")
+    if study_status is None:
+        typer.echo(f"{accession_id} not found in {source}", err=True)
+        raise typer.Exit(1)
+    typer.echo(json.dumps(study_status, indent=2))
+
 
 if __name__ == "__main__":
     app()
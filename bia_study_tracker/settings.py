@@ -1,4 +1,6 @@
+from functools import cache
 from pathlib import Path
+from typing import Literal, Optional
 import logging
 
 from pydantic import Field
@@ -21,9 +23,37 @@ class Settings(BaseSettings):
     public_search_api: str = Field("")
     public_website_url: str = Field("")
     public_mongo_api: str = Field("")
+    biostudies_api: str = Field("https://www.ebi.ac.uk/biostudies/api/v1")
     validation_flag: bool = False
+    validation_tier: Literal["", "metadata", "sampled", "full"] = ""
+    validation_sample_size: int = 1
+    validation_sample_scope: Literal["study", "dataset"] = "study"
+    validation_workers: int = 4
+    validation_timeout: float = 600.0
+    validation_cache_max_age_days: int = 90
+    max_concurrent_requests: int = 8
+    mongo_page_size: int = 500
+    request_timeout: float = 60.0
+    max_retries: int = 5
+    retry_budget: int = 200
+    backoff_base: float = 1.0
+    backoff_max: float = 30.0
+    cache_dir: str = Field(".bia_tracker_cache")
+    biostudies_cache_ttl_days: int = 7
+    metrics_file: str = Field("bia_tracker_metrics.json")
+    history_file: str = Field("bia_tracker_history.sqlite")
+    slack_performance_table: bool = False
+    report_writer: Literal["streaming", "pandas"] = "streaming"
+    status_port: int = 8750
+    status_refresh_minutes: float = 60.0
     slack_bot_token: str = Field("")
     slack_channel: str = Field("")
 
+    def get_validation_tier(self) -> Optional[str]:
+        """VALIDATION_TIER if set, otherwise "full" when the legacy VALIDATION_FLAG is on."""
+        return self.validation_tier or ("full" if self.validation_flag else None)
+
+@cache
 def get_settings():
+    """Settings are read from the environment on first use, not at import, and shared afterwards."""
     return Settings()
\ No newline at end of file
@@ -0,0 +1,216 @@
+"""
+Watch mode: an in-memory status index of every study, refreshed on a timer and served over local HTTP.
+
+    GET /status               when the index was last refreshed, number of studies, last refresh error
+    GET /status/<accession>   dataset/image state, conversion counts, warnings and zarr validity of one study
+
+Each refresh refetches the study and image indexes, and only recomputes the conversion entries of studies that
+changed since the previous refresh. Zarrs aren't validated: their validity is the last outcome cached by
+`generate-report`, and unknown (counted in `n_unknown_zarr`) for zarrs it hasn't validated yet. The server keeps its own snapshot, so its refreshes don't affect the changes a report lists since
+the last report. The index is also saved to it, so `status <accession>` can answer while the server is down.
+"""
+
+import json
+import logging
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Optional
+from bia_study_tracker.settings import get_settings
+from bia_study_tracker.utils.metrics import reset_metrics
+from bia_study_tracker.utils.records import StudyRecord
+from bia_study_tracker.utils.snapshot import SnapshotStore, content_hash
+
+if TYPE_CHECKING:
+    from bia_study_tracker.utils.analysis import BIAAnalysis
+
+logger = logging.getLogger(__name__)
+
+STATUS_KIND = "status"
+STATUS_SNAPSHOT = "status.sqlite"
+
+
+def snapshot_path() -> Path:
+    return Path(get_settings().cache_dir) / STATUS_SNAPSHOT
+
+
+def zarr_validity(entry: Optional[dict[str, Any]]) -> Optional[bool]:
+    """Whether every zarr of the study passed its last validation. None when validation is off, or when no zarr
+    failed but some were never validated."""
+    if not entry or "n_valid_zarr" not in entry:
+        return None
+    n_unknown = entry.get("n_unknown_zarr", 0)
+    if entry["n_valid_zarr"] + n_unknown < entry["n_img_rep_have_zarr"]:
+        return False
+    return None if n_unknown else True
+
+
+def build_status_index(studies: list[StudyRecord], analysis: "BIAAnalysis") -> dict[str, dict[str, Any]]:
+    """Status of every study in BIA or BioStudies, keyed by accession."""
+    from bia_study_tracker.utils.reports import get_study_category
+
+    in_biostudies = set(analysis.report.biostudies.studies_with)
+    index = {}
+    for study in studies:
+        entry = analysis.conversion_report.get(study.accession_id)
+        index[study.accession_id] = {
+            "accession_id": study.accession_id,
+            "uuid": study.uuid,
+            "title": study.title,
+            "release_date": study.release_date,
+            "in_bia": True,
+            "in_biostudies": study.accession_id in in_biostudies,
+            # with_images, without_images (datasets but no images) or without_datasets
+            "state": get_study_category(study),
+            "n_datasets": len(study.datasets),
+            "conversion": entry,
+            "zarr_valid": zarr_validity(entry),
+        }
+    for accession_id in analysis.report.biostudies.studies_without:
+        index[accession_id] = {"accession_id": accession_id, "in_bia": False, "in_biostudies": True,
+                               "state": "not_in_bia"}
+    return index
+
+
+class StatusIndex:
+    def __init__(self) -> None:
+        self.studies: dict[str, dict[str, Any]] = {}
+        self.refreshed_at: Optional[datetime] = None
+        self.last_error: Optional[str] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.refreshed_at is not None
+
+    def refresh(self) -> None:
+        """Rebuild the index from the APIs and the snapshot, then swap it in, so lookups never see a partial index."""
+        from bia_study_tracker.study_tracker import BIAStudyTracker
+
+        tracker = BIAStudyTracker(snapshot_name=STATUS_SNAPSHOT)
+        try:
+            analysis = tracker.analyse(validate=False)
+            studies = build_status_index(tracker.studies_in_bia, analysis)
+            self.save(tracker.snapshot, studies)
+        finally:
+            tracker.snapshot.close()
+        self.studies = studies
+        self.refreshed_at = datetime.now(timezone.utc)
+        logger.info(f"Status index refreshed: {len(studies)} studies")
+
+    @staticmethod
+    def save(store: SnapshotStore, studies: dict[str, dict[str, Any]]) -> None:
+        """Write the studies whose status changed since the last save."""
+        hashes = {acc: content_hash(status) for acc, status in studies.items()}
+        previous = store.hashes(STATUS_KIND)
+        changed = {acc: studies[acc] for acc, h in hashes.items() if previous.get(acc) != h}
+        store.delete(STATUS_KIND, previous.keys() - studies.keys())
+        store.upsert(STATUS_KIND, changed, hashes)
+        store.set_refreshed(STATUS_KIND)
+
+    def run(self, interval: float, stop: threading.Event, after_refresh: Optional[Callable[[], None]] = None) -> None:
+        """Refresh every `interval` seconds until `stop` is set. A failed refresh keeps the previous index.
+        Each refresh has its own metrics and retry budget, like a separate run."""
+        from bia_study_tracker.utils.API_client import reset_retry_budget
+
+        while not stop.is_set():
+            reset_metrics()
+            reset_retry_budget()
+            try:
+                self.refresh()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+                logger.error(f"Status index refresh failed: {e}")
+            if after_refresh:
+                after_refresh()
+            stop.wait(interval)
+
+    def summary(self) -> dict[str, Any]:
+        return {
+            "refreshed_at": self.refreshed_at.isoformat() if self.refreshed_at else None,
+            "n_studies": len(self.studies),
+            "last_error": self.last_error,
+        }
+
+
+class StatusServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, index: StatusIndex, port: int, host: str = "127.0.0.1") -> None:
+        super().__init__((host, port), StatusRequestHandler)
+        self.index = index
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+
+class StatusRequestHandler(BaseHTTPRequestHandler):
+    server: StatusServer
+
+    def do_GET(self) -> None:
+        index = self.server.index
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if parts == ["status"]:
+            self._send(200, index.summary())
+        elif len(parts) != 2 or parts[0] != "status":
+            self._send(404, {"error": f"Unknown path {self.path}, use /status/<accession>"})
+        elif not index.ready:
+            self._send(503, {"error": "The status index is still loading"})
+        elif (status := index.studies.get(parts[1])) is None:
+            self._send(404, {"error": f"{parts[1]} is neither in BIA nor in BioStudies"})
+        else:
+            self._send(200, status | {"refreshed_at": index.summary()["refreshed_at"]})
+
+    def _send(self, code: int, body: dict[str, Any]) -> None:
+        data = json.dumps(body, default=str).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.debug(format % args)
+
+
+def serve(port: int, refresh_minutes: float, after_refresh: Optional[Callable[[], None]] = None) -> None:
+    """Serve the status index until interrupted, refreshing it in a background thread."""
+    index = StatusIndex()
+    stop = threading.Event()
+    refresher = threading.Thread(target=index.run, args=(refresh_minutes * 60, stop, after_refresh),
+                                 name="status-refresh", daemon=True)
+    server = StatusServer(index, port)
+    refresher.start()
+    logger.info(f"Serving study status on {server.url}/status/<accession>, refreshed every {refresh_minutes} minutes")
+    try:
+        server.serve_forever()
+    finally:
+        stop.set()
+        server.server_close()
+
+
+def lookup_status(accession_id: str, url: str, timeout: float = 2.0) -> tuple[Optional[dict[str, Any]], str]:
+    """Status of a study from the server at `url`, or from the index it last saved when it can't be reached.
+    Returns the status (None if unknown) and where it came from."""
+    import requests
+
+    try:
+        response = requests.get(f"{url}/status/{accession_id}", timeout=timeout)
+        if response.status_code != 503:
+            return (response.json() if response.ok else None), url
+    except requests.RequestException:
+        logger.info(f"No status server at {url}, reading the last saved status index")
+    path = snapshot_path()
+    if not path.exists():
+        return None, str(path)
+    store = SnapshotStore(path)
+    try:
+        status = store.get(STATUS_KIND, accession_id)
+        refreshed_at = store.refreshed_at(STATUS_KIND)
+    finally:
+        store.close()
+    if status is not None:
+        status["refreshed_at"] = refreshed_at.isoformat() if refreshed_at else None
+    return status, str(path)
@@ -3,78 +3,253 @@ BIA Study Tracker module for analyzing studies and generating reports.
 """
 
 import logging
+import sqlite3
+import threading
+from dataclasses import asdict
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Optional
-from bia_study_tracker.utils.API_client import API
-from bia_study_tracker.utils.reports import generate_bia_report, generate_detailed_report_file, \
-    generate_conversion_report, compare_mongo_elastic_study_list
+from typing import Any, Iterator, Optional
+from bia_study_tracker.utils.API_client import API, flatten_list
+from bia_study_tracker.utils.reports import BIAReport, generate_detailed_report_file, build_image_lookup, \
+    get_report_file_listings, get_study_image_uuids
+from bia_study_tracker.utils.analysis import BIAAnalysis, analyse_bia
+from bia_study_tracker.utils.biostudies import BioStudiesStudy, FileListing, get_biostudies_studies
+from bia_study_tracker.utils.checkpoint import RunCheckpoint
+from bia_study_tracker.utils.conversion_cache import ConversionCache, ConversionDelta
+from bia_study_tracker.utils.history import record_run
+from bia_study_tracker.utils.metrics import get_metrics, timed
+from bia_study_tracker.utils.records import ImageRecord, StudyRecord
+from bia_study_tracker.utils.sharding import Shard, ShardResult, find_shard_results, merge_shard_results
+from bia_study_tracker.utils.snapshot import SnapshotStore
+from bia_study_tracker.utils.sync import StudyIndex, format_sync_report, reconcile_studies
 from bia_study_tracker.settings import get_settings
 from datetime import datetime
-from bia_ingest.biostudies.find_bia_studies import get_all_bia_studies
-from bia_ingest.biostudies.api import SearchResult
 
 
 logger = logging.getLogger(__name__)
 
+DATA_SOURCES = ["studies_in_bia", "images_in_bia", "studies_in_biostudies", "studies_in_mongo"]
+
+
+def write_report(
+    report: BIAReport,
+    conversion_report: dict[str, Any],
+    accession_lookup: dict[str, StudyRecord],
+    file_listings: Optional[dict[str, FileListing]] = None,
+    conversion_delta: Optional[ConversionDelta] = None,
+) -> tuple[dict[str, Any], Path]:
+    """Write the detailed Excel report and return the report dict posted to Slack, with the path of the file."""
+    logger.info(f"{len(report.image.studies_without)} studies without images (showing up to 5): {report.image.studies_without[:5]}")
+    logger.info(f"{len(report.dataset.studies_without)} studies without datasets (showing up to 5): {report.dataset.studies_without[:5]}")
+
+    summary = report.get_summary_statistics()
+    logger.info(f"Summary: {summary}")
+
+    report_dict = report.to_dict() | {"summary_stats": summary, "summary_cols": ["Statistic", "Value"]}
+    path, summary = generate_detailed_report_file(accession_lookup, report_dict, conversion_report, Path(f"{datetime.now().strftime("%d-%b-%Y")}-detailed_report.xlsx"), file_listings)
+    logger.info(f"Detailed report saved to {path}")
+    report_dict["summary_stats"] = summary
+    if conversion_delta:
+        report_dict["conversion_delta"] = asdict(conversion_delta)
+    settings = get_settings()
+    if settings.history_file:
+        try:
+            trend = record_run(Path(settings.history_file), summary, conversion_report,
+                               settings.get_validation_tier(), path)
+            if trend:
+                report_dict["trend"] = trend
+        except (OSError, sqlite3.Error) as e:
+            logger.error(f"Could not add the run to the history in {settings.history_file}: {e}")
+    return report_dict, path
+
+
+def merge_shard_reports(paths: list[Path]) -> tuple[dict[str, Any], Path]:
+    """Combine the shard results found in `paths` (files or directories) into the detailed report of the whole archive."""
+    files = find_shard_results(paths)
+    merged = merge_shard_results([ShardResult.read(path) for path in files])
+    logger.info(f"Merged {len(files)} shard results")
+    return write_report(merged.report, merged.conversion_report, merged.accession_lookup, merged.file_listings,
+                        merged.conversion_delta)
+
+
 class BIAStudyTracker:
-    def __init__(self, api_endpoint: Optional[str] = None) -> None:
+    def __init__(self, api_endpoint: Optional[str] = None, full_refresh: bool = False, shard: Optional[Shard] = None,
+                 snapshot_name: Optional[str] = None) -> None:
         self.settings = get_settings()
         endpoint = api_endpoint or self.settings.public_search_api
         if not endpoint:
             raise ValueError("API endpoint must be provided (param or PUBLIC_SEARCH_API env var)")
-        self.client = API(endpoint, 100)
-        self.mongo_client = API(self.settings.public_mongo_api, 100)
-        self._studies_cache: Optional[list[dict[str, Any]]] = None
-        self._studies_in_mongo_cache: Optional[list[dict[str, Any]]] = None
-        self._images_cache: Optional[list[dict[str, Any]]] = None
-        self._biostudies_cache: Optional[list[dict[str, Any]]] = None
+        self.client = API(endpoint, 100, self.settings.max_concurrent_requests)
+        self.mongo_client = API(self.settings.public_mongo_api, self.settings.mongo_page_size)
+        self._studies_cache: Optional[list[StudyRecord]] = None
+        self._studies_in_mongo_cache: Optional[list[StudyRecord]] = None
+        self._images_cache: Optional[dict[str, ImageRecord]] = None
+        self._biostudies_cache: Optional[list[BioStudiesStudy]] = None
+        self.full_refresh = full_refresh
+        # Only the studies of this shard are reported on. Each shard keeps its own snapshot, and so does any other
+        # user of the tracker given a `snapshot_name`, so that it doesn't consume the report's changes since the last run
+        self.shard = shard
+        if snapshot_name is None:
+            snapshot_name = f"snapshot-shard-{shard.index}-of-{shard.count}.sqlite" if shard else "snapshot.sqlite"
+        self.snapshot = SnapshotStore(Path(self.settings.cache_dir) / snapshot_name)
+        # Set for the duration of a report run, see start_checkpoint
+        self.checkpoint: Optional[RunCheckpoint] = None
+        # Each data source loads at most once, whether from a prefetch thread or on first access
+        self._locks = {source: threading.Lock() for source in DATA_SOURCES}
+        self._prefetches: dict[str, Future] = {}
+        # The source a prefetch thread is loading, which mustn't wait for its own future
+        self._prefetching = threading.local()
         logger.info(f"BIAStudyTracker initialized with endpoint: {endpoint}")
 
 
+    def prefetch(self, *sources: str) -> dict[str, Future]:
+        """Start loading the given data sources in parallel threads, so the total wait is that of the slowest one.
+        Accessing a source that is still loading blocks until it is ready, and re-raises the error of a failed
+        prefetch instead of loading the source again."""
+        executor = ThreadPoolExecutor(max_workers=len(sources), thread_name_prefix="prefetch")
+        futures = {source: executor.submit(self._prefetch, source) for source in sources}
+        for source, future in futures.items():
+            future.add_done_callback(
+                lambda f, source=source: f.exception() and logger.error(f"Prefetching {source} failed: {f.exception()}")
+            )
+        executor.shutdown(wait=False)
+        self._prefetches |= futures
+        return futures
+
+    def _prefetch(self, source: str) -> Any:
+        self._prefetching.source = source
+        return getattr(self, source)
+
+    def _wait_for_prefetch(self, source: str) -> None:
+        future = self._prefetches.get(source)
+        if future is not None and getattr(self._prefetching, "source", None) != source:
+            future.result()
+
     @property
-    def studies_in_mongo(self) -> list[dict[str, Any]]:
-        if self._studies_in_mongo_cache is None:
-            self._studies_in_mongo_cache = self.mongo_client.request("search/study?page_size=10000")
-            logger.info(f"Retrieved {len(self._studies_in_mongo_cache)} studies from BIA Mongo")
+    def studies_in_mongo(self) -> list[StudyRecord]:
+        self._wait_for_prefetch("studies_in_mongo")
+        with self._locks["studies_in_mongo"]:
+            if self._studies_in_mongo_cache is None:
+                with get_metrics().stage("fetch_studies_in_mongo"):
+                    self._studies_in_mongo_cache = list(
+                        self.mongo_client.iter_objects_by_uuid("search/study", StudyRecord.from_document)
+                    )
+                logger.info(f"Retrieved {len(self._studies_in_mongo_cache)} studies from BIA Mongo")
         return self._studies_in_mongo_cache
 
     @property
-    def studies_in_biostudies(self) -> list[SearchResult]:
-        if self._biostudies_cache is None:
-            self._biostudies_cache = get_all_bia_studies(100)
-            logger.info(f"Retrieved {len(self._biostudies_cache)} studies from BioStudies.")
+    def studies_in_biostudies(self) -> list[BioStudiesStudy]:
+        self._wait_for_prefetch("studies_in_biostudies")
+        with self._locks["studies_in_biostudies"]:
+            if self._biostudies_cache is None:
+                with get_metrics().stage("fetch_studies_in_biostudies"):
+                    self._biostudies_cache = get_biostudies_studies(self.full_refresh)
+                logger.info(f"Retrieved {len(self._biostudies_cache)} studies from BioStudies.")
         return self._biostudies_cache
 
     @property
-    def studies_in_bia(self) -> list[dict[str, Any]]:
-        if self._studies_cache is None:
-            self._studies_cache = self.client.get_all_objects_from_search("search/fts?query=")
-            logger.info(f"Retrieved {len(self._studies_cache)} studies from BIA")
+    def studies_in_bia(self) -> list[StudyRecord]:
+        self._wait_for_prefetch("studies_in_bia")
+        with self._locks["studies_in_bia"]:
+            if self._studies_cache is None:
+                with get_metrics().stage("fetch_studies_in_bia"):
+                    self._studies_cache = flatten_list(self._iter_search_pages("search/fts?query=", StudyRecord))
+                if self.shard:
+                    self._studies_cache = [study for study in self._studies_cache if study.accession_id in self.shard]
+                logger.info(f"Retrieved {len(self._studies_cache)} studies from BIA")
         return self._studies_cache
 
     @property
-    def images_in_bia(self) -> list[dict[str, Any]]:
-        if self._images_cache is None:
-            self._images_cache = self.client.get_all_objects_from_search("search/fts/image?query=")
-            logger.info(f"Retrieved {len(self._images_cache)} images from BIA")
+    def images_in_bia(self) -> dict[str, ImageRecord]:
+        """Image records keyed by uuid, built while streaming the image index page by page.
+        The whole index is fetched on every run: the search API can't list which images changed, and adding a
+        thumbnail or a representation to an image doesn't change its study document."""
+        self._wait_for_prefetch("images_in_bia")
+        with self._locks["images_in_bia"]:
+            if self._images_cache is None:
+                with get_metrics().stage("fetch_images_in_bia"):
+                    # A shard only keeps the images of its studies
+                    wanted = {uuid for study in self.studies_in_bia for uuid in get_study_image_uuids(study)} \
+                        if self.shard else None
+                    self._images_cache = build_image_lookup(
+                        image for page in self._iter_search_pages("search/fts/image?query=", ImageRecord)
+                        for image in page if wanted is None or image.uuid in wanted
+                    )
+                logger.info(f"Retrieved {len(self._images_cache)} images from BIA")
         return self._images_cache
 
-    def generate_report(self) -> tuple[dict[str, Any], Path]:
-        report = generate_bia_report(self.studies_in_bia, self.studies_in_biostudies)
-        logger.info(f"{len(report.image.studies_without)} studies without images (showing up to 5): {report.image.studies_without[:5]}")
-        logger.info(f"{len(report.dataset.studies_without)} studies without datasets (showing up to 5): {report.dataset.studies_without[:5]}")
+    def _iter_search_pages(self, api_endpoint: str, record_type: type[StudyRecord] | type[ImageRecord]) -> Iterator[list]:
+        """Records of a search endpoint, one page at a time. During a checkpointed run each page is saved as it
+        arrives, and the pages saved by an interrupted attempt are read back instead of being fetched again."""
+        if self.checkpoint is None:
+            yield from self.client.iter_pages_from_search(api_endpoint, record_type.from_document)
+            return
+        kind = f"pages {api_endpoint}"
+        saved = self.checkpoint.saved_pages(kind)
+        for documents in self.checkpoint.load_pages(kind, saved):
+            yield [record_type.from_dict(document) for document in documents]
+        for page, records in self.client.iter_numbered_pages_from_search(api_endpoint, record_type.from_document,
+                                                                         skip=set(saved)):
+            self.checkpoint.save_page(kind, page, [record.to_dict() for record in records])
+            yield records
+
+    def _iter_biostudies_accessions(self):
+        # A generator so that analyse_bia only waits for BioStudies when it reaches the overlap step
+        for study in self.studies_in_biostudies:
+            if self.shard is None or study.accession in self.shard:
+                yield study.accession
+
+    def start_checkpoint(self, resume: bool = False) -> RunCheckpoint:
+        """Checkpoint the work of this run in CACHE_DIR, continuing from a previous interrupted run when `resume`."""
+        run_dir = f"run-shard-{self.shard.index}-of-{self.shard.count}" if self.shard else "run"
+        config = {"validation_tier": self.settings.get_validation_tier(), "shard": str(self.shard) if self.shard else None}
+        self.checkpoint = RunCheckpoint(Path(self.settings.cache_dir) / run_dir, config, resume)
+        return self.checkpoint
+
+    def analyse(self, validate: bool = True) -> BIAAnalysis:
+        """With `validate` False, zarrs aren't validated and their cached validation outcomes are reported."""
+        self.prefetch("studies_in_bia", "images_in_bia", "studies_in_biostudies")
+        studies, images = self.studies_in_bia, self.images_in_bia
+        validation_tier = self.settings.get_validation_tier()
+        conversion_cache = ConversionCache(self.snapshot, validation_tier, reuse=not self.full_refresh)
+        return analyse_bia(studies, images, self._iter_biostudies_accessions(), validation_tier, self.checkpoint,
+                           conversion_cache, validate)
 
-        summary = report.get_summary_statistics()
-        logger.info(f"Summary: {summary}")
+    def generate_report(self, resume: bool = False) -> tuple[dict[str, Any], Path]:
+        checkpoint = self.start_checkpoint(resume)
+        analysis = self.analyse()
+        result = write_report(analysis.report, analysis.conversion_report, analysis.accession_lookup,
+                              conversion_delta=analysis.conversion_delta)
+        checkpoint.complete()
+        return result
 
-        report_dict = report.to_dict() | {"summary_stats": summary, "summary_cols": ["Statistic", "Value"]}
-        detailed_report = generate_conversion_report(self.studies_in_bia, self.images_in_bia,
-                                                     report_dict["image"]["studies_with"], self.settings.validation_flag)
-        path, summary = generate_detailed_report_file(self.studies_in_bia, report_dict, detailed_report, Path(f"{datetime.now().strftime("%d-%b-%Y")}-detailed_report.xlsx"))
-        logger.info(f"Detailed report saved to {path}")
-        report_dict["summary_stats"] = summary
-        return report_dict, path
+    def generate_shard_report(self, output_dir: Path, resume: bool = False) -> Path:
+        """Analyse this shard's studies, including zarr validation and BioStudies lookups, and save the result
+        for `merge_shard_reports`."""
+        if self.shard is None:
+            raise ValueError("generate_shard_report needs a shard")
+        checkpoint = self.start_checkpoint(resume)
+        analysis = self.analyse()
+        report_dict = analysis.report.to_dict()
+        file_listings = get_report_file_listings(analysis.accession_lookup, report_dict)
+        result = ShardResult(self.shard, analysis.report, analysis.conversion_report, analysis.accession_lookup,
+                             file_listings, analysis.conversion_delta)
+        path = result.write(output_dir / self.shard.filename)
+        checkpoint.complete()
+        return path
 
+    @timed("mongo_elastic_sync")
     def check_mongo_elastic_sync(self) -> str:
-        result = compare_mongo_elastic_study_list(self.studies_in_bia, self.studies_in_mongo)
+        """Reconcile the search and Mongo study lists. Both sides are streamed page by page into
+        per-accession content hashes in parallel, without keeping the study records. A page that fails on
+        either side raises, so a partial list is never reported as studies missing from the other side."""
+        logger.info("Checking mongo elastic sync.")
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix="sync") as executor:
+            search_index = executor.submit(StudyIndex.from_records, self.client.iter_objects_from_search(
+                "search/fts?query=", StudyRecord.from_document))
+            mongo_index = executor.submit(StudyIndex.from_records, self.mongo_client.iter_objects_by_uuid(
+                "search/study", StudyRecord.from_document))
+            sync_report = reconcile_studies(search_index.result(), mongo_index.result())
+        result = format_sync_report(sync_report)
+        logger.info(result)
         return result
\ No newline at end of file
@@ -1,10 +1,101 @@
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from itertools import islice
+from typing import TYPE_CHECKING, Any, Callable, Container, Optional
 import requests
+from requests.adapters import HTTPAdapter
 import logging
+from bia_study_tracker.settings import get_settings
+from bia_study_tracker.utils.metrics import get_metrics
+
+if TYPE_CHECKING:
+    import aiohttp
 
 
 logger = logging.getLogger(__name__)
 
-def handle_search_results(response):
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+RETRY_AFTER_STATUS_CODES = {429, 503}
+
+
+class RetryBudget:
+    """Number of retries left for the whole run, shared by every API instance."""
+
+    def __init__(self, total: int) -> None:
+        self.remaining = total
+        self._lock = threading.Lock()
+
+    def consume(self) -> bool:
+        with self._lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+
+_session: Optional[requests.Session] = None
+_retry_budget: Optional[RetryBudget] = None
+_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """Keep-alive session shared by every API instance so connections are reused across pages."""
+    global _session
+    with _lock:
+        if _session is None:
+            pool_size = max(10, get_settings().max_concurrent_requests)
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+
+def get_retry_budget() -> RetryBudget:
+    global _retry_budget
+    with _lock:
+        if _retry_budget is None:
+            _retry_budget = RetryBudget(get_settings().retry_budget)
+        return _retry_budget
+
+
+def reset_retry_budget() -> None:
+    """Start a new retry budget, e.g. for each refresh of a long-running server."""
+    global _retry_budget
+    with _lock:
+        _retry_budget = None
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, base: float, cap: float, retry_after: Optional[float] = None) -> float:
+    """Seconds to wait before retry number `attempt`: the server's Retry-After if given,
+    otherwise exponential backoff with full jitter. Both are capped at `cap`."""
+    if retry_after is not None:
+        return min(retry_after, cap)
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def handle_search_results(response, parse: Optional[Callable[[dict], Any]] = None):
+    """Return the `_source` of each hit, parsed into a compact record by `parse` when given."""
+    if parse:
+        return [parse(hit["_source"]) for hit in response["hits"]["hits"]]
     return [hit["_source"] for hit in response["hits"]["hits"] ]
 
 
@@ -13,36 +104,179 @@ def flatten_list(list_of_lists):
 
 
 class API:
-    def __init__(self, link, page_size=100):
+    def __init__(self, link, page_size=100, max_concurrent_requests=1):
+        settings = get_settings()
         self.link = link
         self.page_size = page_size
+        self.max_concurrent_requests = max(1, max_concurrent_requests)
+        self.timeout = settings.request_timeout
+        self.max_retries = settings.max_retries
+        self.backoff_base = settings.backoff_base
+        self.backoff_max = settings.backoff_max
+
+    def _next_delay(self, attempt: int, retry_after: Optional[float]) -> Optional[float]:
+        """Delay before the next attempt, or None when this request or the run is out of retries."""
+        if attempt >= self.max_retries or not get_retry_budget().consume():
+            return None
+        return backoff_delay(attempt, self.backoff_base, self.backoff_max, retry_after)
 
     def request(self, endpoint: str):
-        response = {}
+        url = f"{self.link}/{endpoint}"
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            start = time.perf_counter()
+            try:
+                response = get_session().get(url, timeout=self.timeout)
+                get_metrics().record_request(url, time.perf_counter() - start, len(response.content),
+                                             response.status_code == 200, attempt)
+                if response.status_code == 200:
+                    return response.json()
+                logger.info(f"Failed to make the request! {response.status_code} for {url}")
+                if response.status_code not in RETRY_STATUS_CODES:
+                    return None
+                if response.status_code in RETRY_AFTER_STATUS_CODES:
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            except requests.exceptions.RequestException as e:
+                get_metrics().record_request(url, time.perf_counter() - start, 0, False, attempt)
+                logger.info(f"An error occurred: {e}")
+            delay = self._next_delay(attempt, retry_after)
+            if delay is None:
+                break
+            time.sleep(delay)
+        logger.error(f"Giving up on {url} after {attempt + 1} attempt(s)")
+        return None
+
+    async def _request_async(self, session: "aiohttp.ClientSession", semaphore: asyncio.Semaphore, endpoint: str):
+        import aiohttp
+
+        url = f"{self.link}/{endpoint}"
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    async with session.get(url) as response:
+                        body = await response.read()
+                        get_metrics().record_request(url, time.perf_counter() - start, len(body),
+                                                     response.status == 200, attempt)
+                        if response.status == 200:
+                            return await response.json()
+                        logger.info(f"Failed to make the request! {response.status} for {url}")
+                        if response.status not in RETRY_STATUS_CODES:
+                            return None
+                        if response.status in RETRY_AFTER_STATUS_CODES:
+                            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    get_metrics().record_request(url, time.perf_counter() - start, 0, False, attempt)
+                    logger.info(f"An error occurred: {e!r}")
+            # Back off outside the semaphore so waiting pages don't block healthy ones
+            delay = self._next_delay(attempt, retry_after)
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+        logger.error(f"Giving up on {url} after {attempt + 1} attempt(s)")
+        return None
+
+    async def _aiter_responses(self, api_endpoint: str, pages: list[int]):
+        """Yield (page, response) in page order from one session, keeping at most `max_concurrent_requests`
+        requests in flight. Up to twice as many pages are queued ahead, so a slow or backing-off page only
+        holds back the pages after it in the queue, not the connections."""
+        import aiohttp
+
+        semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+        connector = aiohttp.TCPConnector(limit=self.max_concurrent_requests)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        remaining = iter(pages)
+        queue: deque[tuple[int, asyncio.Task]] = deque()
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+
+            def enqueue(n: int) -> None:
+                for page in islice(remaining, n):
+                    endpoint = api_endpoint + f"&pagination.page={page}"
+                    queue.append((page, asyncio.create_task(self._request_async(session, semaphore, endpoint))))
+
+            try:
+                enqueue(2 * self.max_concurrent_requests)
+                while queue:
+                    page, task = queue.popleft()
+                    response = await task
+                    enqueue(1)
+                    yield page, response
+            finally:
+                for _, task in queue:
+                    task.cancel()
+                await asyncio.gather(*(task for _, task in queue), return_exceptions=True)
+
+    def _iter_responses(self, api_endpoint: str, pages: list[int]):
+        """Yield (page, response) in page order. Concurrent fetching runs on an event loop owned by this
+        generator, which only holds the queued pages in memory."""
+        if self.max_concurrent_requests == 1:
+            for page in pages:
+                yield page, self.request(api_endpoint + f"&pagination.page={page}")
+            return
+        loop = asyncio.new_event_loop()
+        responses = self._aiter_responses(api_endpoint, pages)
         try:
-            response = requests.get(f"{self.link}/{endpoint}")
-            if response.status_code == 200:
-                return response.json()
-            else:
-                logger.info("Failed to make the request!")
-                response.raise_for_status()
-        except requests.exceptions.RequestException as e:
-            logger.info(f"An error occurred: {e}")
-            return None
+            while True:
+                try:
+                    response = loop.run_until_complete(anext(responses))
+                except StopAsyncIteration:
+                    return
+                yield response
+        finally:
+            loop.run_until_complete(responses.aclose())
+            loop.close()
 
-    def get_all_objects_from_search(self, api_endpoint: str):
+    def iter_numbered_pages_from_search(self, api_endpoint: str, parse: Optional[Callable[[dict], Any]] = None,
+                                        skip: Container[int] = ()):
+        """Yield (page, documents) for every page of a search endpoint not in `skip`. The first page is always
+        requested, to learn the number of pages. A page that fails after every retry raises, as partial results
+        would be reported as missing studies and images; the pages yielded before it can be checkpointed."""
         api_endpoint = api_endpoint + f"&pagination.page_size={self.page_size}"
         first_page = api_endpoint + f"&pagination.page=1"
-        results = []
         first_request = self.request(first_page)
-        if first_request:
-            results.append(handle_search_results(first_request))
-            total_pages = first_request["pagination"]["total_pages"]
-            page = 2
-            while page <= total_pages:
-                response = self.request(api_endpoint + f"&pagination.page={page}")
-                if response:
-                    results.append(handle_search_results(response))
-                    page += 1
-
-        return flatten_list(results)
\ No newline at end of file
+        if not first_request:
+            raise RuntimeError(f"Failed to fetch {self.link}/{first_page}")
+        total_pages = first_request["pagination"]["total_pages"]
+        if 1 not in skip:
+            yield 1, handle_search_results(first_request, parse)
+        del first_request
+        pages = [page for page in range(2, total_pages + 1) if page not in skip]
+        for page, response in self._iter_responses(api_endpoint, pages):
+            if not response:
+                raise RuntimeError(f"Failed to fetch page {page}/{total_pages} of {self.link}/{api_endpoint}")
+            yield page, handle_search_results(response, parse)
+
+    def iter_pages_from_search(self, api_endpoint: str, parse: Optional[Callable[[dict], Any]] = None):
+        """Yield the `_source` documents of a search endpoint one page at a time."""
+        for _, documents in self.iter_numbered_pages_from_search(api_endpoint, parse):
+            yield documents
+
+    def iter_objects_from_search(self, api_endpoint: str, parse: Optional[Callable[[dict], Any]] = None):
+        for page in self.iter_pages_from_search(api_endpoint, parse):
+            yield from page
+
+    def iter_pages_by_uuid(self, api_endpoint: str, parse: Optional[Callable[[dict], Any]] = None):
+        """Yield pages of a Mongo API list endpoint, which pages with a `start_from_uuid` cursor.
+        Like a search page, a page that fails after every retry raises."""
+        cursor = None
+        while True:
+            endpoint = f"{api_endpoint}?page_size={self.page_size}" + (f"&start_from_uuid={cursor}" if cursor else "")
+            page = self.request(endpoint)
+            if page is None:
+                raise RuntimeError(f"Failed to fetch {self.link}/{endpoint}")
+            # The cursor object itself may be returned again at the top of the next page
+            documents = [document for document in page if document["uuid"] != cursor]
+            if not documents:
+                return
+            yield [parse(document) for document in documents] if parse else documents
+            if len(page) < self.page_size:
+                return
+            cursor = page[-1]["uuid"]
+
+    def iter_objects_by_uuid(self, api_endpoint: str, parse: Optional[Callable[[dict], Any]] = None):
+        for page in self.iter_pages_by_uuid(api_endpoint, parse):
+            yield from page
+
+    def get_all_objects_from_search(self, api_endpoint: str, parse: Optional[Callable[[dict], Any]] = None):
+        return flatten_list(self.iter_pages_from_search(api_endpoint, parse))
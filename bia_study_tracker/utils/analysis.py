@@ -0,0 +1,100 @@
+"""
+Single-pass analysis of the BIA study list.
+
+`analyse_bia` computes the study categorisation, the BioStudies overlap and the conversion report in one
+traversal of the studies, using dict/set indexes for every membership test.
+"""
+
+import logging
+from dataclasses import dataclass
+from typing import Any, Iterable, Optional
+from bia_study_tracker.utils.checkpoint import RunCheckpoint
+from bia_study_tracker.utils.conversion_cache import ConversionCache, ConversionDelta
+from bia_study_tracker.utils.metrics import timed
+from bia_study_tracker.utils.records import ImageRecord, StudyRecord
+from bia_study_tracker.utils.reports import BIAReport, Statistics, build_study_conversion_entry, \
+    get_study_category, load_study_zarr_validations, validate_study_zarrs
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class BIAAnalysis:
+    report: BIAReport
+    conversion_report: dict[str, Any]
+    # studies without images or datasets, for the detailed report sheets
+    accession_lookup: dict[str, StudyRecord]
+    conversion_delta: Optional[ConversionDelta] = None
+
+
+@timed("analysis")
+def analyse_bia(
+    studies: list[StudyRecord],
+    image_lookup: dict[str, ImageRecord],
+    biostudies_accessions: Iterable[str],
+    validation_tier: Optional[str] = None,
+    checkpoint: Optional[RunCheckpoint] = None,
+    conversion_cache: Optional[ConversionCache] = None,
+    validate: bool = True,
+) -> BIAAnalysis:
+    """With a `checkpoint`, conversion entries saved by an interrupted run are reused (without revalidating
+    their zarrs), and each new entry and validation outcome is saved as soon as it is known.
+    With a `conversion_cache`, only the entries of studies that changed since the last run are recomputed,
+    and the analysis includes what changed.
+    With `validate` False, no zarr is validated and the cached outcomes of previous validations are used instead."""
+    saved_entries = checkpoint.load("conversion") if checkpoint else {}
+    if conversion_cache and saved_entries:
+        # Entries are checkpointed with their fingerprint, see below
+        for accession_id, fingerprint in checkpoint.hashes("conversion").items():
+            conversion_cache.restore(accession_id, fingerprint)
+    validation_results = {}
+    if validation_tier:
+        # Zarrs are validated as one parallel batch, so they have to be collected before the main pass
+        with_images = [s.accession_id for s in studies
+                       if get_study_category(s) == "with_images" and s.accession_id not in saved_entries]
+        if validate:
+            validation_results = validate_study_zarrs(studies, image_lookup, with_images, validation_tier, checkpoint)
+        else:
+            validation_results = load_study_zarr_validations(studies, image_lookup, with_images, validation_tier)
+
+    # dicts are used as insertion-ordered sets
+    categories: dict[str, dict[str, None]] = {"with_images": {}, "without_images": {}, "without_datasets": {}}
+    conversion_report: dict[str, Any] = {}
+    accession_lookup: dict[str, StudyRecord] = {}
+    for study in studies:
+        accession_id = study.accession_id
+        category = get_study_category(study)
+        categories[category][accession_id] = None
+        if category == "with_images":
+            entry = saved_entries.get(accession_id)
+            if entry is None:
+                if conversion_cache:
+                    entry = conversion_cache.get(study, image_lookup, validation_results)
+                entry = entry or build_study_conversion_entry(study, image_lookup, validation_results, validation_tier,
+                                                                validate)
+                if checkpoint:
+                    fingerprint = conversion_cache.fingerprints[accession_id] if conversion_cache else None
+                    checkpoint.save("conversion", {accession_id: entry},
+                                    {accession_id: fingerprint} if fingerprint else None)
+            conversion_report[accession_id] = entry
+        else:
+            accession_lookup[accession_id] = study
+
+    conversion_delta = conversion_cache.update(conversion_report) if conversion_cache else None
+
+    with_images, without_datasets = categories["with_images"], categories["without_datasets"]
+    all_ids = with_images | categories["without_images"] | without_datasets
+    without_images = [acc for acc in categories["without_images"] if acc not in with_images and acc not in without_datasets]
+    with_datasets = [acc for acc in all_ids if acc not in without_datasets]
+
+    in_bia, not_in_bia = [], []
+    for accession in biostudies_accessions:
+        (in_bia if accession in all_ids else not_in_bia).append(accession)
+
+    report = BIAReport(
+        total_studies=len(studies),
+        image=Statistics(list(with_images), without_images),
+        dataset=Statistics(with_datasets, list(without_datasets)),
+        biostudies=Statistics(in_bia, not_in_bia),
+    )
+    return BIAAnalysis(report, conversion_report, accession_lookup, conversion_delta)
@@ -0,0 +1,163 @@
+"""
+BioStudies API lookups, fetched concurrently and cached on disk.
+"""
+
+import logging
+import math
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Optional
+from bia_study_tracker.settings import get_settings
+from bia_study_tracker.utils.API_client import API
+from bia_study_tracker.utils.metrics import timed
+from bia_study_tracker.utils.snapshot import SnapshotStore
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class FileListing:
+    n_files: Optional[int]
+    extensions: str
+    status: str = "ok"
+
+    @property
+    def failed(self) -> bool:
+        return self.status != "ok"
+
+
+@dataclass(slots=True, frozen=True)
+class BioStudiesStudy:
+    """The fields of a BioStudies search hit the report reads."""
+    accession: str
+    release_date: str
+
+    @classmethod
+    def from_hit(cls, hit: dict[str, Any]) -> "BioStudiesStudy":
+        return cls(accession=hit["accession"], release_date=str(hit.get("release_date") or ""))
+
+
+def _search_endpoint(page: int, page_size: int) -> str:
+    # Newest releases first, so an incremental update can stop at the first page older than the cache
+    return f"BioImages/search?pageSize={page_size}&page={page}&sortBy=release_date&sortOrder=descending"
+
+
+def _fetch_newer_studies(client: API, first_page: dict[str, Any],
+                         cached: dict[str, BioStudiesStudy]) -> Optional[dict[str, BioStudiesStudy]]:
+    """The cached studies updated with the pages of studies released since the newest cached release date.
+    None if a page couldn't be fetched."""
+    newest = max(study.release_date for study in cached.values())
+    n_pages = math.ceil(first_page["totalHits"] / client.page_size)
+    studies = dict(cached)
+    page, hits = 1, first_page["hits"]
+    while True:
+        studies.update((hit["accession"], BioStudiesStudy.from_hit(hit)) for hit in hits)
+        # Studies released on the newest cached date may not all be cached yet, so paging stops below it
+        if not hits or page >= n_pages or min(str(hit.get("release_date") or "") for hit in hits) < newest:
+            logger.info(f"Fetched {page} of {n_pages} BioStudies search pages, released since {newest}")
+            return studies
+        page += 1
+        response = client.request(_search_endpoint(page, client.page_size))
+        if response is None:
+            return None
+        hits = response["hits"]
+
+
+def _fetch_all_studies(client: API, first_page: dict[str, Any], max_workers: int) -> dict[str, BioStudiesStudy]:
+    n_pages = math.ceil(first_page["totalHits"] / client.page_size)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pages = [first_page, *executor.map(lambda page: client.request(_search_endpoint(page, client.page_size)),
+                                           range(2, n_pages + 1))]
+    if failed := [page for page, response in enumerate(pages, start=1) if response is None]:
+        raise RuntimeError(f"{len(failed)} of {n_pages} BioStudies search pages failed (e.g. page {failed[0]})")
+    logger.info(f"Fetched all {n_pages} BioStudies search pages")
+    return {hit["accession"]: BioStudiesStudy.from_hit(hit) for response in pages for hit in response["hits"]}
+
+
+@timed("biostudies_studies")
+def get_biostudies_studies(full_refresh: bool = False) -> list[BioStudiesStudy]:
+    """Every study of the BioImages collection, newest release first.
+
+    The list is cached in CACHE_DIR. Within BIOSTUDIES_CACHE_TTL_DAYS of the last full enumeration, only the
+    search pages of studies released since the newest cached release date are fetched. Otherwise, with
+    `full_refresh`, or if the number of hits no longer matches the cache (e.g. a study was withdrawn), every page
+    is fetched concurrently."""
+    settings = get_settings()
+    client = API(settings.biostudies_api, 100)
+    cache = SnapshotStore(Path(settings.cache_dir) / "biostudies.sqlite")
+    try:
+        first_page = client.request(_search_endpoint(1, client.page_size))
+        if first_page is None:
+            raise RuntimeError("BioStudies search failed")
+        cached = {acc: BioStudiesStudy(**study) for acc, study in cache.load("study").items()}
+        refreshed_at = cache.refreshed_at("study")
+        is_fresh = refreshed_at and datetime.now(timezone.utc) - refreshed_at < timedelta(days=settings.biostudies_cache_ttl_days)
+
+        studies = None
+        if cached and is_fresh and not full_refresh:
+            studies = _fetch_newer_studies(client, first_page, cached)
+            if studies is not None and len(studies) != first_page["totalHits"]:
+                logger.info(f"BioStudies reports {first_page['totalHits']} studies, {len(studies)} known, "
+                            f"fetching all of them.")
+                studies = None
+            elif studies is not None:
+                # The refresh time stays that of the last full enumeration
+                cache.upsert("study", {acc: asdict(study) for acc, study in studies.items() if cached.get(acc) != study})
+        if studies is None:
+            studies = _fetch_all_studies(client, first_page, settings.max_concurrent_requests)
+            cache.replace("study", {acc: asdict(study) for acc, study in studies.items()})
+    finally:
+        cache.close()
+    return sorted(studies.values(), key=lambda study: (study.release_date, study.accession), reverse=True)
+
+
+def get_file_count_and_extension(client: API, accession_id: str) -> FileListing:
+    response_json = client.request(f"files/{accession_id}")
+    if not response_json:
+        return FileListing(None, "", "Error getting file types")
+    counts = response_json["recordsTotal"]
+    extension = ["dir" if data["type"] == "directory" else data["Name"].split(".")[-1] for data in response_json["data"]]
+    return FileListing(counts, ", ".join(set(extension)))
+
+
+@timed("biostudies_file_listings")
+def get_file_listings(accession_ids: dict[str, str]) -> dict[str, FileListing]:
+    """File count and extensions for each accession, keyed by accession.
+
+    `accession_ids` maps each accession to a version marker (e.g. its release date). Cached listings are
+    reused while younger than BIOSTUDIES_CACHE_TTL_DAYS and the marker is unchanged. Failed lookups are
+    returned with their error status and never cached."""
+    settings = get_settings()
+    cache = SnapshotStore(Path(settings.cache_dir) / "biostudies.sqlite")
+    cached, markers = cache.load("files"), cache.hashes("files")
+    min_fetched_at = datetime.now(timezone.utc) - timedelta(days=settings.biostudies_cache_ttl_days)
+
+    listings: dict[str, FileListing] = {}
+    to_fetch = []
+    for acc, marker in accession_ids.items():
+        entry = cached.get(acc)
+        if entry and markers[acc] == marker and datetime.fromisoformat(entry["fetched_at"]) > min_fetched_at:
+            listings[acc] = FileListing(entry["n_files"], entry["extensions"])
+        else:
+            to_fetch.append(acc)
+    logger.info(f"Fetching BioStudies file listings for {len(to_fetch)} studies "
+                f"({len(listings)} reused from cache)")
+
+    client = API(settings.biostudies_api)
+    with ThreadPoolExecutor(max_workers=settings.max_concurrent_requests) as executor:
+        fetched = dict(zip(to_fetch, executor.map(lambda acc: get_file_count_and_extension(client, acc), to_fetch)))
+    listings |= fetched
+
+    fetched_at = datetime.now(timezone.utc).isoformat()
+    succeeded = {acc: listing for acc, listing in fetched.items() if not listing.failed}
+    cache.upsert(
+        "files",
+        {acc: {"n_files": l.n_files, "extensions": l.extensions, "fetched_at": fetched_at} for acc, l in succeeded.items()},
+        {acc: accession_ids[acc] for acc in succeeded},
+    )
+    if n_failed := len(fetched) - len(succeeded):
+        logger.warning(f"{n_failed} BioStudies file listing lookups failed")
+    cache.close()
+    return listings
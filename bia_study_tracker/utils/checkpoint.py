@@ -0,0 +1,74 @@
+"""
+Checkpoints of an unfinished `generate-report` run, so that `--resume` only does the remaining work.
+
+The run directory holds the search pages fetched so far, the conversion report entry of each study and the zarr
+validation outcomes. It is removed once the report has been written.
+"""
+
+import logging
+import shutil
+import threading
+from pathlib import Path
+from typing import Any, Iterable, Iterator, Optional
+from bia_study_tracker.utils.snapshot import SnapshotStore
+
+logger = logging.getLogger(__name__)
+
+
+class RunCheckpoint:
+    def __init__(self, path: Path, config: dict[str, Any], resume: bool = False) -> None:
+        """`config` identifies the run (e.g. validation tier, shard). A checkpoint saved with a different config
+        isn't resumed, as its results wouldn't match."""
+        self.path = path
+        if path.exists():
+            previous = SnapshotStore(path / "checkpoint.sqlite")
+            saved_config = previous.load("run").get("config")
+            previous.close()
+            if not resume:
+                logger.info(f"Discarding the checkpoint of a previous run in {path}")
+                shutil.rmtree(path)
+            elif saved_config != config:
+                logger.warning(f"Checkpoint in {path} was saved with {saved_config}, not {config}, starting over.")
+                shutil.rmtree(path)
+            else:
+                logger.info(f"Resuming the run checkpointed in {path}")
+        self.store = SnapshotStore(path / "checkpoint.sqlite")
+        # Every page, conversion entry and validation outcome is its own transaction. In WAL mode with normal
+        # synchronisation they don't wait for a disk sync, and a committed one still survives the process crashing
+        self.store.connection.execute("PRAGMA journal_mode=WAL")
+        self.store.connection.execute("PRAGMA synchronous=NORMAL")
+        self.store.upsert("run", {"config": config})
+        # Pages and validation results are saved from the prefetch and validation threads
+        self._lock = threading.Lock()
+
+    def load(self, kind: str) -> dict[str, Any]:
+        with self._lock:
+            return self.store.load(kind)
+
+    def hashes(self, kind: str) -> dict[str, str]:
+        with self._lock:
+            return self.store.hashes(kind)
+
+    def save(self, kind: str, documents: dict[str, Any], hashes: Optional[dict[str, str]] = None) -> None:
+        with self._lock:
+            self.store.upsert(kind, documents, hashes)
+
+    def saved_pages(self, kind: str) -> list[int]:
+        """Numbers of the saved pages, in page order."""
+        return sorted(int(page) for page in self.hashes(kind))
+
+    def load_pages(self, kind: str, pages: Iterable[int]) -> Iterator[list[Any]]:
+        """The given saved pages, read one at a time so that only one of them is held in memory."""
+        for page in pages:
+            with self._lock:
+                documents = self.store.get(kind, str(page))
+            yield documents
+
+    def save_page(self, kind: str, page: int, documents: list[Any]) -> None:
+        self.save(kind, {str(page): documents})
+
+    def complete(self) -> None:
+        """The run finished, its checkpoint is no longer needed."""
+        with self._lock:
+            self.store.close()
+            shutil.rmtree(self.path, ignore_errors=True)
@@ -0,0 +1,97 @@
+"""
+Conversion report entries of the previous run, reused for studies that haven't changed since.
+
+Each entry is stored with a fingerprint of its study record, its image records and the validation outcomes of its
+zarrs, everything the entry is computed from. An entry is recomputed as soon as any of them changed, e.g. when an
+image gained a thumbnail.
+"""
+
+import hashlib
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Optional
+from bia_study_tracker.settings import get_settings
+from bia_study_tracker.utils.records import ImageRecord, StudyRecord
+from bia_study_tracker.utils.reports import get_study_image_uuids
+from bia_study_tracker.utils.snapshot import SnapshotStore, content_hash
+from bia_study_tracker.utils.zarr_validation import ValidationResult
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ConversionDelta:
+    """Studies with images whose conversion report entry changed since the last run with the same validation tier."""
+    new: list[str] = field(default_factory=list)
+    updated: list[str] = field(default_factory=list)
+    removed: list[str] = field(default_factory=list)
+
+
+class ConversionCache:
+    def __init__(
+        self,
+        store: SnapshotStore,
+        validation_tier: Optional[str],
+        reuse: bool = True,
+    ) -> None:
+        """With `reuse` False every entry is recomputed, and still compared with the previous run."""
+        # Entries differ between validation tiers, so each tier is compared with its own previous run
+        self.kind = f"conversion_{validation_tier or 'none'}"
+        self.store = store
+        self.validation_tier = validation_tier
+        self.reuse = reuse
+        self.previous: dict[str, Any] = store.load(self.kind)
+        self.previous_fingerprints = store.hashes(self.kind)
+        self.fingerprints: dict[str, str] = {}
+        self.n_reused = 0
+
+    def fingerprint(self, study: StudyRecord, image_lookup: dict[str, ImageRecord],
+                    validation_results: dict[str, ValidationResult]) -> str:
+        parts = [self.validation_tier or "", get_settings().public_website_url,
+                 content_hash(study.to_dict())]
+        for uuid in get_study_image_uuids(study):
+            image = image_lookup.get(uuid)
+            if image is None:
+                parts.append(f"{uuid}:missing")
+                continue
+            parts.append(content_hash(image.to_dict()))
+            for rep in image.representations:
+                result = validation_results.get(rep.file_uri)
+                if result:
+                    parts.append(f"{result.tier}:{result.valid}:{result.error}")
+        return hashlib.blake2b("\x1f".join(parts).encode(), digest_size=16).hexdigest()
+
+    def get(self, study: StudyRecord, image_lookup: dict[str, ImageRecord],
+            validation_results: dict[str, ValidationResult]) -> Optional[dict[str, Any]]:
+        """The previous entry of the study if its fingerprint is unchanged, otherwise None."""
+        fingerprint = self.fingerprint(study, image_lookup, validation_results)
+        self.fingerprints[study.accession_id] = fingerprint
+        if self.reuse and self.previous_fingerprints.get(study.accession_id) == fingerprint:
+            self.n_reused += 1
+            return self.previous[study.accession_id]
+        return None
+
+    def restore(self, accession_id: str, fingerprint: str) -> None:
+        """Fingerprint of an entry restored from a run checkpoint, so that `update` saves and compares it like an
+        entry of this run."""
+        self.fingerprints[accession_id] = fingerprint
+
+    def update(self, conversion_report: dict[str, Any]) -> ConversionDelta:
+        """Save the entries that changed and return what changed since the previous run."""
+        delta = ConversionDelta()
+        changed = {}
+        for accession_id, entry in conversion_report.items():
+            fingerprint = self.fingerprints.get(accession_id)
+            if fingerprint is None or self.previous_fingerprints.get(accession_id) == fingerprint:
+                continue
+            changed[accession_id] = entry
+            if accession_id not in self.previous:
+                delta.new.append(accession_id)
+            elif self.previous[accession_id] != entry:
+                delta.updated.append(accession_id)
+        delta.removed = sorted(self.previous.keys() - conversion_report.keys())
+        self.store.delete(self.kind, delta.removed)
+        self.store.upsert(self.kind, changed, {acc: self.fingerprints[acc] for acc in changed})
+        logger.info(f"Conversion report: {self.n_reused} entries reused, {len(changed)} recomputed. Since the last run "
+                    f"{len(delta.new)} new, {len(delta.updated)} updated and {len(delta.removed)} removed studies")
+        return delta
@@ -0,0 +1,50 @@
+"""
+Streaming Excel sheets for the detailed report file.
+
+The workbook is opened in xlsxwriter's `constant_memory` mode, which flushes each row to disk as soon as the next one
+is started, so memory stays flat however many studies are reported. Column widths are tracked while the rows are
+written and applied when the sheet is closed.
+"""
+
+from typing import Any, Iterable, Optional
+from xlsxwriter import Workbook
+from xlsxwriter.format import Format
+from xlsxwriter.worksheet import Worksheet
+
+
+def open_workbook(path) -> Workbook:
+    return Workbook(str(path), {"constant_memory": True})
+
+
+def cell_value(value: Any) -> Any:
+    """The value as pandas would write it: numbers and booleans as they are, missing values empty, anything else
+    (lists, dicts) as its string representation."""
+    if value is None:
+        return ""
+    if isinstance(value, (bool, int, float)):
+        return value
+    return str(value)
+
+
+class StreamingSheet:
+    def __init__(self, workbook: Workbook, name: str, columns: list[str], header_format: Optional[Format] = None):
+        self.worksheet: Worksheet = workbook.add_worksheet(name)
+        self.widths = [0] * len(columns)
+        self.n_rows = 0
+        self.write_row(columns, header_format)
+
+    def write_row(self, values: Iterable[Any], cell_format: Optional[Format] = None) -> None:
+        for col, value in enumerate(values):
+            value = cell_value(value)
+            self.worksheet.write(self.n_rows, col, value, cell_format)
+            self.widths[col] = max(self.widths[col], len(str(value)))
+        self.n_rows += 1
+
+    def write_rows(self, rows: Iterable[Iterable[Any]]) -> None:
+        for row in rows:
+            self.write_row(row)
+
+    def close(self) -> None:
+        # Column settings are written with the sheet header when the workbook closes, so they can be set last
+        for col, width in enumerate(self.widths):
+            self.worksheet.set_column(col, col, width + 2)
@@ -0,0 +1,163 @@
+"""
+History of report runs: the summary statistics and per-study conversion counts of every run, for trends.
+
+Runs are appended to a SQLite file in long, narrow tables (one row per statistic, one row per study), so a run of
+thousands of studies adds a few hundred KB. Trends are computed on DataFrames of the whole history: the change of
+each statistic since the previous run, weekly ingestion throughput, and the studies whose counts dropped.
+"""
+
+import logging
+import sqlite3
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Optional
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+STUDY_COLUMNS = ["n_images", "n_thumbnail", "n_static_display", "n_img_rep", "n_img_rep_have_zarr", "n_valid_zarr"]
+# A drop in any of these columns since the previous run is a regression of the study
+REGRESSIONS = {
+    "n_thumbnail": "lost thumbnails",
+    "n_static_display": "lost static display",
+    "n_img_rep": "lost representations",
+    "n_img_rep_have_zarr": "lost zarr",
+    "n_valid_zarr": "lost valid zarr",
+}
+THROUGHPUT_STATISTIC = "Total Studies checked in Search API"
+
+
+class RunHistory:
+    def __init__(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS runs (
+                run_id INTEGER PRIMARY KEY,
+                run_at TEXT NOT NULL,
+                validation_tier TEXT,
+                report_file TEXT
+            );
+            CREATE TABLE IF NOT EXISTS summary (
+                run_id INTEGER NOT NULL,
+                statistic TEXT NOT NULL,
+                value INTEGER,
+                PRIMARY KEY (run_id, statistic)
+            ) WITHOUT ROWID;
+            """
+            f"""
+            CREATE TABLE IF NOT EXISTS studies (
+                run_id INTEGER NOT NULL,
+                accession_id TEXT NOT NULL,
+                {", ".join(f"{column} INTEGER" for column in STUDY_COLUMNS)},
+                PRIMARY KEY (run_id, accession_id)
+            ) WITHOUT ROWID;
+            """
+        )
+
+    def append(self, summary: dict[str, Any], conversion_report: dict[str, Any], validation_tier: Optional[str],
+               report_file: Optional[Path] = None, run_at: Optional[datetime] = None) -> int:
+        """Record a run and return its id."""
+        run_at = run_at or datetime.now(timezone.utc)
+        with self.connection:
+            run_id = self.connection.execute(
+                "INSERT INTO runs (run_at, validation_tier, report_file) VALUES (?, ?, ?)",
+                (run_at.isoformat(), validation_tier, str(report_file) if report_file else None),
+            ).lastrowid
+            self.connection.executemany(
+                "INSERT INTO summary (run_id, statistic, value) VALUES (?, ?, ?)",
+                ((run_id, statistic, int(value)) for statistic, value in summary.items()),
+            )
+            self.connection.executemany(
+                f"INSERT INTO studies VALUES (?, ?, {', '.join('?' * len(STUDY_COLUMNS))})",
+                ((run_id, acc, *(entry.get(column) for column in STUDY_COLUMNS))
+                 for acc, entry in conversion_report.items()),
+            )
+        logger.info(f"Run {run_id} added to the run history ({len(conversion_report)} studies)")
+        return run_id
+
+    def load_runs(self) -> "pd.DataFrame":
+        import pandas as pd
+
+        runs = pd.read_sql("SELECT * FROM runs ORDER BY run_id", self.connection, index_col="run_id")
+        runs["run_at"] = pd.to_datetime(runs["run_at"], utc=True, format="ISO8601")
+        return runs
+
+    def load_summaries(self) -> "pd.DataFrame":
+        """One row per run, one column per statistic."""
+        import pandas as pd
+
+        summary = pd.read_sql("SELECT run_id, statistic, value FROM summary", self.connection)
+        return summary.pivot(index="run_id", columns="statistic", values="value").sort_index()
+
+    def load_studies(self, run_ids: list[int]) -> "pd.DataFrame":
+        import pandas as pd
+
+        placeholders = ", ".join("?" * len(run_ids))
+        return pd.read_sql(f"SELECT * FROM studies WHERE run_id IN ({placeholders})", self.connection,
+                           params=run_ids)
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def find_regressions(studies: "pd.DataFrame", previous_run: int, latest_run: int,
+                     compare_validation: bool = True) -> dict[str, list[str]]:
+    """Studies of the latest run with lower counts than in the previous run, by kind of regression, and the
+    studies with images in the previous run that no longer have any."""
+    before = studies[studies["run_id"] == previous_run].set_index("accession_id")
+    after = studies[studies["run_id"] == latest_run].set_index("accession_id")
+    both = before.join(after, how="inner", lsuffix="_before")
+    regressions = {}
+    for column, label in REGRESSIONS.items():
+        if column == "n_valid_zarr" and not compare_validation:
+            continue
+        # Comparisons with missing counts (e.g. zarrs not validated) are False
+        dropped = both.index[both[column] < both[f"{column}_before"]]
+        regressions[label] = sorted(dropped)
+    regressions["no longer with images"] = sorted(before.index.difference(after.index))
+    return regressions
+
+
+def compute_trend(history: RunHistory) -> Optional[dict[str, Any]]:
+    """Changes between the last two runs and the ingestion throughput over the whole history,
+    None until there are two runs."""
+    runs = history.load_runs()
+    if len(runs) < 2:
+        return None
+    summaries = history.load_summaries().reindex(runs.index)
+    previous_run, latest_run = runs.index[-2], runs.index[-1]
+
+    deltas = summaries.diff().iloc[-1]
+    latest = summaries.iloc[-1]
+    # Statistics added or renamed between the two runs have no change
+    compared = summaries.columns[latest.notna() & deltas.notna()]
+    days = runs["run_at"].diff().dt.total_seconds() / 86400
+    weekly_throughput = (summaries[THROUGHPUT_STATISTIC].diff() / days.where(days > 0) * 7).dropna()
+
+    tiers = runs.loc[[previous_run, latest_run], "validation_tier"]
+    regressions = find_regressions(history.load_studies([previous_run, latest_run]), previous_run, latest_run,
+                                   compare_validation=tiers.notna().all() and tiers.nunique() == 1)
+    return {
+        "previous_run_at": runs.loc[previous_run, "run_at"].isoformat(),
+        "n_runs": len(runs),
+        "changes": {statistic: {"value": int(latest[statistic]), "change": int(deltas[statistic])}
+                    for statistic in compared},
+        "studies_per_week": round(float(weekly_throughput.iloc[-1]), 1) if len(weekly_throughput) else None,
+        "mean_studies_per_week": round(float(weekly_throughput.mean()), 1) if len(weekly_throughput) else None,
+        "regressions": {label: accessions for label, accessions in regressions.items() if accessions},
+    }
+
+
+def record_run(path: Path, summary: dict[str, Any], conversion_report: dict[str, Any],
+               validation_tier: Optional[str], report_file: Optional[Path] = None) -> Optional[dict[str, Any]]:
+    """Append the run to the history at `path` and return its trend (see `compute_trend`)."""
+    history = RunHistory(path)
+    try:
+        history.append(summary, conversion_report, validation_tier, report_file)
+        return compute_trend(history)
+    finally:
+        history.close()
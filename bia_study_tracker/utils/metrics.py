@@ -0,0 +1,186 @@
+"""
+Run metrics: wall time per stage, HTTP requests per endpoint, zarr validation durations and peak memory.
+
+Metrics are collected in a process-wide `RunMetrics`, written to METRICS_FILE as JSON at the end of a command,
+and optionally summarised in the Slack message.
+"""
+
+import functools
+import json
+import logging
+import math
+import re
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Optional
+from urllib.parse import urlparse
+from prettytable import PrettyTable
+
+logger = logging.getLogger(__name__)
+
+ACCESSION_PATTERN = re.compile(r"S-[A-Z]+\d+")
+
+
+def endpoint_name(url: str) -> str:
+    """Host and path of a url without its query, with accessions replaced so that per-study requests are grouped."""
+    parsed = urlparse(url)
+    return ACCESSION_PATTERN.sub("{accession}", f"{parsed.netloc}{parsed.path}")
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile of `values`, `q` in [0, 100]."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered), max(1, math.ceil(q / 100 * len(ordered)))) - 1]
+
+
+@dataclass
+class EndpointStats:
+    requests: int = 0
+    failures: int = 0
+    retries: int = 0
+    bytes: int = 0
+    latencies: list[float] = field(default_factory=list)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "failures": self.failures,
+            "retries": self.retries,
+            "bytes": self.bytes,
+            "latency_p50": round(percentile(self.latencies, 50), 4),
+            "latency_p95": round(percentile(self.latencies, 95), 4),
+            "latency_p99": round(percentile(self.latencies, 99), 4),
+            "latency_max": round(max(self.latencies, default=0.0), 4),
+        }
+
+
+@dataclass
+class StageStats:
+    seconds: float = 0.0
+    calls: int = 0
+
+
+class RunMetrics:
+    def __init__(self) -> None:
+        self.started_at = datetime.now(timezone.utc)
+        self.stages: dict[str, StageStats] = {}
+        self.http: dict[str, EndpointStats] = {}
+        self.validations: dict[str, list[float]] = {}
+        self.validation_timeouts: dict[str, int] = {}
+        self.validation_cached: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time a block as stage `name`. Repeated stages add up, stages running in parallel threads overlap."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                stats = self.stages.setdefault(name, StageStats())
+                stats.seconds += elapsed
+                stats.calls += 1
+
+    def record_request(self, url: str, seconds: float, n_bytes: int, ok: bool, attempt: int) -> None:
+        """Record one HTTP attempt. `attempt` > 0 means it was a retry."""
+        with self._lock:
+            stats = self.http.setdefault(endpoint_name(url), EndpointStats())
+            stats.requests += 1
+            stats.failures += not ok
+            stats.retries += attempt > 0
+            stats.bytes += n_bytes
+            stats.latencies.append(seconds)
+
+    def record_validation(self, tier: str, seconds: float, timed_out: bool) -> None:
+        with self._lock:
+            self.validations.setdefault(tier, []).append(seconds)
+            self.validation_timeouts[tier] = self.validation_timeouts.get(tier, 0) + timed_out
+
+    def record_cached_validations(self, tier: str, count: int) -> None:
+        with self._lock:
+            self.validation_cached[tier] = self.validation_cached.get(tier, 0) + count
+
+    def to_dict(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "started_at": self.started_at.isoformat(),
+                "finished_at": datetime.now(timezone.utc).isoformat(),
+                "stages": {name: {"seconds": round(stats.seconds, 4), "calls": stats.calls}
+                           for name, stats in self.stages.items()},
+                "http": {endpoint: stats.to_dict() for endpoint, stats in sorted(self.http.items())},
+                "zarr_validation": {
+                    tier: {
+                        "validated": len(durations := self.validations.get(tier, [])),
+                        "cached": self.validation_cached.get(tier, 0),
+                        "timed_out": self.validation_timeouts.get(tier, 0),
+                        "seconds_total": round(sum(durations), 4),
+                        "seconds_p50": round(percentile(durations, 50), 4),
+                        "seconds_p95": round(percentile(durations, 95), 4),
+                        "seconds_max": round(max(durations, default=0.0), 4),
+                    }
+                    for tier in sorted(self.validations.keys() | self.validation_cached.keys())
+                },
+                # ru_maxrss is in KiB on Linux. Validation worker processes are counted separately
+                "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                "peak_rss_children_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+            }
+
+    def write(self, path: Path) -> Path:
+        path.write_text(json.dumps(self.to_dict(), indent=2) + "\n")
+        logger.info(f"Run metrics saved to {path}")
+        return path
+
+
+_metrics: Optional[RunMetrics] = None
+_lock = threading.Lock()
+
+
+def get_metrics() -> RunMetrics:
+    global _metrics
+    with _lock:
+        if _metrics is None:
+            _metrics = RunMetrics()
+        return _metrics
+
+
+def reset_metrics() -> None:
+    """Start recording a new run, e.g. for each refresh of a long-running command."""
+    global _metrics
+    with _lock:
+        _metrics = None
+
+
+def timed(name: str):
+    """Decorator recording each call of the function as stage `name`."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with get_metrics().stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def format_performance_table(metrics: dict[str, Any]) -> str:
+    """Compact summary of a `RunMetrics.to_dict()` for Slack: time per stage, then requests per endpoint."""
+    stages = PrettyTable(["Stage", "Seconds"])
+    stages.align = "l"
+    for name, stats in metrics["stages"].items():
+        stages.add_row([name, f"{stats['seconds']:.1f}"])
+    stages.add_row(["peak memory (MB)", metrics["peak_rss_mb"]])
+
+    http = PrettyTable(["Endpoint", "Requests", "Retries", "MB", "p95 (s)"])
+    http.align = "l"
+    for endpoint, stats in metrics["http"].items():
+        http.add_row([urlparse(f"//{endpoint}").path, stats["requests"], stats["retries"],
+                      f"{stats['bytes'] / 1e6:.1f}", f"{stats['latency_p95']:.2f}"])
+    return f"{stages.get_formatted_string()}\n{http.get_formatted_string()}"
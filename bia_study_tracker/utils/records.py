@@ -0,0 +1,100 @@
+"""
+Compact records for the study and image search documents.
+
+Search hits are parsed into these as soon as they are received (see `API.iter_pages_from_search`), keeping only
+the fields the reports read instead of the whole Elasticsearch `_source`, so tens of thousands of them stay cheap
+to hold and to garbage collect. Each record also keeps the `version` of its document, so that a record compares
+unequal (and hashes differently) once its document was updated, even in fields the reports don't read.
+"""
+
+from dataclasses import asdict, dataclass
+from typing import Any, Optional
+
+
+@dataclass(slots=True)
+class DatasetRecord:
+    image_count: int
+    image_uuids: tuple[str, ...]
+    has_example_image: bool
+
+    @classmethod
+    def from_document(cls, dataset: dict[str, Any]) -> "DatasetRecord":
+        return cls(
+            image_count=dataset.get("image_count") or 0,
+            image_uuids=tuple(img["uuid"] for img in dataset.get("image") or []),
+            has_example_image=bool(dataset.get("example_image_uri")),
+        )
+
+
+@dataclass(slots=True)
+class StudyRecord:
+    accession_id: str
+    uuid: str
+    title: str
+    release_date: str
+    version: int
+    datasets: tuple[DatasetRecord, ...] = ()
+
+    @classmethod
+    def from_document(cls, study: dict[str, Any]) -> "StudyRecord":
+        return cls(
+            accession_id=study["accession_id"],
+            uuid=study.get("uuid", ""),
+            title=study.get("title", ""),
+            release_date=str(study.get("release_date", "")),
+            version=study.get("version") or 0,
+            datasets=tuple(DatasetRecord.from_document(ds) for ds in study.get("dataset") or []),
+        )
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> "StudyRecord":
+        return cls(**(data | {"datasets": tuple(
+            DatasetRecord(ds["image_count"], tuple(ds["image_uuids"]), ds["has_example_image"]) for ds in data["datasets"]
+        )}))
+
+    def to_dict(self) -> dict[str, Any]:
+        return asdict(self)
+
+
+@dataclass(slots=True)
+class RepresentationRecord:
+    uuid: str
+    image_format: str
+    file_uri: Optional[str]
+
+    @classmethod
+    def from_document(cls, rep: dict[str, Any]) -> "RepresentationRecord":
+        return cls(
+            uuid=rep.get("uuid", ""),
+            image_format=rep.get("image_format", ""),
+            file_uri=rep["file_uri"][0] if rep.get("file_uri") else None,
+        )
+
+    @property
+    def is_zarr(self) -> bool:
+        return self.image_format.endswith("ome.zarr")
+
+
+@dataclass(slots=True)
+class ImageRecord:
+    uuid: str
+    has_thumbnail: bool
+    version: int
+    representations: tuple[RepresentationRecord, ...] = ()
+
+    @classmethod
+    def from_document(cls, image: dict[str, Any]) -> "ImageRecord":
+        return cls(
+            uuid=image["uuid"],
+            has_thumbnail=any(m.get("name") == "image_thumbnail_uri" for m in image.get("additional_metadata", [])),
+            version=image.get("version") or 0,
+            representations=tuple(RepresentationRecord.from_document(rep) for rep in image.get("representation", [])),
+        )
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> "ImageRecord":
+        return cls(data["uuid"], data["has_thumbnail"], data["version"],
+                   tuple(RepresentationRecord(**rep) for rep in data["representations"]))
+
+    def to_dict(self) -> dict[str, Any]:
+        return asdict(self)
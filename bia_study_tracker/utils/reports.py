@@ -1,16 +1,16 @@
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any
-import pandas as pd
+from typing import Any, Iterable, Optional
+import hashlib
 import logging
-from bia_ingest.biostudies.api import SearchResult
 from bia_study_tracker.settings import get_settings
-from ngff_zarr import from_ngff_zarr
-from requests import get
+from bia_study_tracker.utils.zarr_validation import ZarrValidator, ValidationResult
+from bia_study_tracker.utils.biostudies import FileListing, get_file_listings
+from bia_study_tracker.utils.checkpoint import RunCheckpoint
+from bia_study_tracker.utils.metrics import timed
+from bia_study_tracker.utils.records import DatasetRecord, ImageRecord, StudyRecord
 from collections import Counter
 
-settings = get_settings()
-
 logger = logging.getLogger(__name__)
 
 @dataclass
@@ -37,8 +37,21 @@ class BIAReport:
                 "studies_with": self.dataset.studies_with,
                 "studies_without": self.dataset.studies_without,
             },
+            "biostudies": {
+                "studies_with": self.biostudies.studies_with,
+                "studies_without": self.biostudies.studies_without,
+            },
         }
 
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> "BIAReport":
+        return cls(
+            total_studies=data["total_studies"],
+            image=Statistics(**data["image"]),
+            dataset=Statistics(**data["dataset"]),
+            biostudies=Statistics(**data["biostudies"]),
+        )
+
     def get_summary_statistics(self) -> dict[str, int]:
         return {
             "Total Studies checked in Search API": self.total_studies,
@@ -51,201 +64,308 @@ class BIAReport:
             "Studies in BIA with datasets but no images": len(self.image.studies_without),
         }
 
-def _categorise_bia_studies(studies: list[dict[str, Any]]) -> list[list[str]]:
-    with_images, without_datasets = [], []
-    for study in studies:
-        acc = study["accession_id"]
-        datasets = study.get("dataset")
-        if not datasets:
-            without_datasets.append(acc)
-            continue
-        if any(_has_images(ds) for ds in datasets):
-            with_images.append(acc)
+def get_study_category(study: StudyRecord) -> str:
+    """One of "without_datasets", "with_images" or "without_images" (has datasets but no images)."""
+    if not study.datasets:
+        return "without_datasets"
+    if any(_has_images(ds) for ds in study.datasets):
+        return "with_images"
+    return "without_images"
 
-    all_ids = {study["accession_id"] for study in studies}
-    without_images = list(all_ids - set(with_images) - set(without_datasets))
-    with_datasets = list(all_ids  - set(without_datasets))
-    return [with_images, without_images, with_datasets, without_datasets, all_ids]
 
+def _has_images(dataset: DatasetRecord) -> bool:
+    return dataset.image_count > 0 or bool(dataset.image_uuids)
 
-def _has_images(dataset: dict[str, Any]) -> bool:
-    return dataset.get("image_count", 0) > 0 or bool(dataset.get("image"))
 
+def get_study_image_uuids(study: StudyRecord) -> list[str]:
+    return [uuid for ds in study.datasets for uuid in ds.image_uuids]
 
-def generate_bia_report(studies_in_bia: list[dict[str, Any]], studies_in_biostudies: list[SearchResult]) -> BIAReport:
-    if not studies_in_bia and len(studies_in_bia) > 0:
-        raise ValueError("Studies list cannot be empty")
+def build_image_lookup(images: Iterable[ImageRecord]) -> dict[str, ImageRecord]:
+    """Consume image records one at a time (e.g. from API.iter_objects_from_search)
+    into a uuid -> record lookup, so a full page list is never held at once."""
+    return {image.uuid: image for image in images}
 
-    with_imgs, without_imgs, with_ds, without_ds, all_ids = _categorise_bia_studies(studies_in_bia)
-    total = len(studies_in_bia)
-    in_bia, not_in_bia = [], []
-    for study in studies_in_biostudies:
-        if study.accession in all_ids:
-            in_bia.append(study.accession)
+def _sample_key(file_uri: str) -> str:
+    return hashlib.sha1(file_uri.encode()).hexdigest()
+
+def select_zarrs_for_validation(
+    studies: list[StudyRecord],
+    image_lookup: dict[str, ImageRecord],
+    studies_with_images: list[str],
+    validation_tier: str,
+) -> dict[str, set[str]]:
+    """Map the "metadata" and "full" tiers to the OME-Zarr file URIs they should run on.
+    The sampled tier fully validates the same N URIs per study (or dataset) on every run, and the rest at metadata tier."""
+    settings = get_settings()
+    studies_with_images = set(studies_with_images)
+    selection: dict[str, set[str]] = {"metadata": set(), "full": set()}
+    for study in studies:
+        if study.accession_id not in studies_with_images:
+            continue
+        if settings.validation_sample_scope == "dataset":
+            groups = [ds.image_uuids for ds in study.datasets]
         else:
-            not_in_bia.append(study.accession)
-
-    report = BIAReport(
-        total_studies=total,
-        image=Statistics(with_imgs, without_imgs),
-        dataset=Statistics(with_ds, without_ds),
-        biostudies=Statistics(in_bia, not_in_bia),
-    )
-    return report
-
-def has_attribute(image: dict, attr: str) -> bool:
-    return attr in [m.get("name") for m in image.get("additional_metadata", [])]
-
-def generate_conversion_report(
-    studies: list[dict[str, Any]],
-    images: list[dict[str, Any]],
+            groups = [get_study_image_uuids(study)]
+        for group in groups:
+            file_uris = sorted({
+                rep.file_uri
+                for uuid in group if uuid in image_lookup
+                for rep in image_lookup[uuid].representations
+                if rep.is_zarr and rep.file_uri
+            }, key=_sample_key)
+            if validation_tier == "sampled":
+                selection["full"].update(file_uris[:settings.validation_sample_size])
+                selection["metadata"].update(file_uris[settings.validation_sample_size:])
+            else:
+                selection[validation_tier].update(file_uris)
+    selection["metadata"] -= selection["full"]
+    return selection
+
+@timed("zarr_validation")
+def validate_study_zarrs(
+    studies: list[StudyRecord],
+    image_lookup: dict[str, ImageRecord],
     studies_with_images: list[str],
-    validation_flag: bool = False,
+    validation_tier: str = "full",
+    checkpoint: Optional[RunCheckpoint] = None,
+) -> dict[str, ValidationResult]:
+    """Validate the OME-Zarr representations of the studies with images in one parallel batch per tier."""
+    validator = ZarrValidator()
+    results: dict[str, ValidationResult] = {}
+    for tier, file_uris in select_zarrs_for_validation(studies, image_lookup, studies_with_images, validation_tier).items():
+        if file_uris:
+            results |= validator.validate(file_uris, tier, checkpoint)
+    return results
+
+def load_study_zarr_validations(
+    studies: list[StudyRecord],
+    image_lookup: dict[str, ImageRecord],
+    studies_with_images: list[str],
+    validation_tier: str = "full",
+) -> dict[str, ValidationResult]:
+    """The cached outcomes of the zarrs `validate_study_zarrs` would validate, without validating any."""
+    validator = ZarrValidator()
+    results: dict[str, ValidationResult] = {}
+    for tier, file_uris in select_zarrs_for_validation(studies, image_lookup, studies_with_images, validation_tier).items():
+        results |= validator.cached_results(file_uris, tier)
+    return results
+
+def build_study_conversion_entry(
+    study: StudyRecord,
+    image_lookup: dict[str, ImageRecord],
+    validation_results: dict[str, ValidationResult],
+    validation_tier: Optional[str] = None,
+    validated: bool = True,
 ) -> dict[str, Any]:
+    """Conversion counts and warnings of a single study with images.
+    With `validated` False the zarrs weren't validated by this run, and those without a cached validation result
+    are counted as unknown (`n_unknown_zarr`) rather than invalid."""
+    accession_id = study.accession_id
+    study_images = get_study_image_uuids(study)
+    n_images = len(study_images)
+
+    n_img_rep = n_thumbnail = n_img_rep_have_zarr = n_valid_zarr = n_unknown_zarr = 0
+    warnings: dict[str, list[str]] = {
+        "missing_rep": [],
+        "missing_static_display": [],
+        "missing_thumbnail": [],
+        "missing_zarr": [],
+        "out_of_sync": [],
+        "invalid_zarr": []
+    }
+    zarr_validation_error_message = ""
+    n_static_display = sum(ds.has_example_image for ds in study.datasets)
+    for uuid in study_images:
+        img = image_lookup.get(uuid)
+
+        if not img:
+            warnings["out_of_sync"].append(uuid)
+            continue
 
-    image_lookup = {d["uuid"]: d for d in images}
-    report: dict[str, Any] = {}
+        if img.has_thumbnail:
+            n_thumbnail += 1
+        else:
+            warnings["missing_thumbnail"].append(uuid)
 
-    for study in studies:
-        accession_id = study["accession_id"]
-        if accession_id not in studies_with_images:
+        if n_static_display == 0:
+            warnings["missing_static_display"].append(uuid)
+
+        reps = img.representations
+        if not reps:
+            warnings["missing_rep"].append(uuid)
             continue
 
-        datasets = study.get("dataset", [])
-        study_images = [img for ds in datasets if "image" in ds for img in ds["image"]]
-        n_images = len(study_images)
-
-        n_img_rep = n_thumbnail = n_img_rep_have_zarr = n_valid_zarr = 0
-        warnings: dict[str, list[str]] = {
-            "missing_rep": [],
-            "missing_static_display": [],
-            "missing_thumbnail": [],
-            "missing_zarr": [],
-            "out_of_sync": [],
-            "invalid_zarr": []
-        }
-        zarr_validation_error_message = ""
-        example_image_uri = [ds.get("example_image_uri")[0] for ds in study.get("dataset", []) if len(ds.get("example_image_uri")) > 0]
-        n_static_display = len(example_image_uri)
-        for i in study_images:
-            uuid = i.get("uuid")
-            img = image_lookup.get(uuid)
-
-            if not img:
-                warnings["out_of_sync"].append(uuid)
-                continue
-
-            if has_attribute(img, "image_thumbnail_uri"):
-                n_thumbnail += 1
-            else:
-                warnings["missing_thumbnail"].append(uuid)
-
-            if n_static_display == 0:
-                warnings["missing_static_display"].append(uuid)
-
-            reps = img.get("representation", [])
-            if not reps:
-                warnings["missing_rep"].append(uuid)
-                continue
-
-            n_img_rep += len(reps)
-            for rep in reps:
-                if rep.get("image_format", "").endswith("ome.zarr"):
-                    n_img_rep_have_zarr += 1
-                    if validation_flag:
-                        try:
-                            file_uri = rep.get("file_uri")[0]
-                            ngff = from_ngff_zarr(file_uri, validate=True)
-                            n_valid_zarr += 1
-                        except Exception as e:
-                            warnings["invalid_zarr"].append(uuid)
-                            error_message = f"Image Rep UUID: {rep.get("uuid", "")} - validation error: {repr(e)}\n"
-                            zarr_validation_error_message += error_message
-
-            if n_img_rep_have_zarr == 0:
-                warnings["missing_zarr"].append(uuid)
-
-        # Compact grouped log for this study
-        warnings = {k: v for k, v in warnings.items() if v}
-        for category, uuids in warnings.items():
-            if uuids:
-                logger.warning(
-                    f"[{accession_id}] {category.replace('_', ' ').title()} "
-                    f"({len(uuids)}): {', '.join(uuids[:5])}"
-                    f"{' ...' if len(uuids) > 5 else ''}"
-                )
-        if len(zarr_validation_error_message) > 0:
-            logging.error(f"[{accession_id}]"+ zarr_validation_error_message)
-        report[accession_id] = {
-            "website_url": f"{settings.public_website_url}/{accession_id}",
-            "n_images": n_images,
-            "n_thumbnail": n_thumbnail,
-            "n_static_display": n_static_display,
-            "n_img_rep": n_img_rep,
-            "n_img_rep_have_zarr": n_img_rep_have_zarr,
-            "warnings": warnings if len(warnings)>0 else "",
-        }
-        if validation_flag:
-            report[accession_id]["n_valid_zarr"] = n_valid_zarr
-            report[accession_id]["zarr_validation_error_message"] = zarr_validation_error_message
-
-    return report
-
-def get_file_count_and_extension(accession_id: str) -> tuple[int, str]:
-    response = get(f"https://www.ebi.ac.uk/biostudies/api/v1/files/{accession_id}")
-    if response.status_code != 200:
-        return 0, "Error getting file types"
-    response_json = response.json()
-    counts = response_json["recordsTotal"]
-    extension = ["dir" if data["type"] == "directory" else data["Name"].split(".")[-1] for data in response_json["data"]]
-    return counts, ", ".join(set(extension))
-
-def get_study_information_by_accession(data: dict, accession_id: str) -> tuple[str, str, str, str]:
-    study = data.get(accession_id, {})
-    uuid , title, release_date = study.get("uuid", ""), study.get("title", ""), study.get("release_date", "")
-    dataset_url = f"{settings.public_mongo_api}/study/{uuid}/dataset?page_size=10"
+        n_img_rep += len(reps)
+        for rep in reps:
+            if rep.is_zarr:
+                n_img_rep_have_zarr += 1
+                if validation_tier:
+                    result = validation_results.get(rep.file_uri)
+                    if result and result.valid:
+                        n_valid_zarr += 1
+                    elif not result and rep.file_uri and not validated:
+                        n_unknown_zarr += 1
+                    else:
+                        if result:
+                            tier, error = result.tier, result.error
+                        else:
+                            # Only zarrs with a file_uri are selected for validation
+                            tier = validation_tier
+                            error = "no file_uri, not validated" if not rep.file_uri else "no validation result"
+                        warnings["invalid_zarr"].append(f"{uuid} ({tier})")
+                        error_message = f"Image Rep UUID: {rep.uuid} - {tier} validation error: {error}\n"
+                        zarr_validation_error_message += error_message
+
+        if n_img_rep_have_zarr == 0:
+            warnings["missing_zarr"].append(uuid)
+
+    # Compact grouped log for this study
+    warnings = {k: v for k, v in warnings.items() if v}
+    for category, uuids in warnings.items():
+        if uuids:
+            logger.warning(
+                f"[{accession_id}] {category.replace('_', ' ').title()} "
+                f"({len(uuids)}): {', '.join(uuids[:5])}"
+                f"{' ...' if len(uuids) > 5 else ''}"
+            )
+    if len(zarr_validation_error_message) > 0:
+        logging.error(f"[{accession_id}]"+ zarr_validation_error_message)
+    entry = {
+        "website_url": f"{get_settings().public_website_url}/{accession_id}",
+        "n_images": n_images,
+        "n_thumbnail": n_thumbnail,
+        "n_static_display": n_static_display,
+        "n_img_rep": n_img_rep,
+        "n_img_rep_have_zarr": n_img_rep_have_zarr,
+        "warnings": warnings if len(warnings)>0 else "",
+    }
+    if validation_tier:
+        entry["n_valid_zarr"] = n_valid_zarr
+        if not validated:
+            entry["n_unknown_zarr"] = n_unknown_zarr
+        entry["zarr_validation_error_message"] = zarr_validation_error_message
+    return entry
+
+def get_study_information_by_accession(data: dict[str, StudyRecord], accession_id: str) -> tuple[str, str, str, str]:
+    study = data.get(accession_id)
+    uuid, title, release_date = (study.uuid, study.title, study.release_date) if study else ("", "", "")
+    dataset_url = f"{get_settings().public_mongo_api}/study/{uuid}/dataset?page_size=10"
     return uuid, dataset_url, title, release_date
 
 
-def generate_object_for_df(data: list, accession_lookup: dict) -> list:
+def generate_row_for_df(acc: str, accession_lookup: dict, file_listings: dict[str, FileListing]) -> list:
     return [
-        [
-            acc,
-            f"{settings.public_website_url}/{acc}",
-            f"https://www.ebi.ac.uk/biostudies/BioImages/studies/{acc}",
-            *get_study_information_by_accession(accession_lookup, acc),
-            *get_file_count_and_extension(acc)
-        ]
-        for acc in data
+        acc,
+        f"{get_settings().public_website_url}/{acc}",
+        f"https://www.ebi.ac.uk/biostudies/BioImages/studies/{acc}",
+        *get_study_information_by_accession(accession_lookup, acc),
+        file_listings[acc].n_files,
+        file_listings[acc].extensions,
+        file_listings[acc].status,
     ]
 
 
+def generate_object_for_df(data: list, accession_lookup: dict, file_listings: dict[str, FileListing]) -> list:
+    return [generate_row_for_df(acc, accession_lookup, file_listings) for acc in data]
+
+
+def get_report_file_listings(accession_lookup: dict[str, StudyRecord], report: dict[str, Any]) -> dict[str, FileListing]:
+    """BioStudies file listings of the studies on the no_images and no_datasets sheets."""
+    # File listings of both sheets are fetched together, keyed by release date so re-released studies are refetched
+    return get_file_listings({
+        acc: accession_lookup[acc].release_date if acc in accession_lookup else ""
+        for acc in [*report["image"]["studies_without"], *report["dataset"]["studies_without"]]
+    })
+
+
+# Columns of the no_images and no_datasets sheets
+DETAILED_SHEET_COLS = ["accession_id", "alpha_url", "original_study_url", "uuid", "dataset_url", "title",
+    "release_date", "n_files_biostudies", "file_format_biostudies (first 5 files)", "biostudies_lookup_status"]
+
+
+@timed("detailed_report_file")
 def generate_detailed_report_file(
-    studies_in_bia: list,
+    accession_lookup: dict[str, StudyRecord],
     report: dict[str, Any],
     conversion_report:  dict[str, Any],
-    output: Path
+    output: Path,
+    file_listings: Optional[dict[str, FileListing]] = None,
 ) -> tuple[Path, dict]:
     """Generate a detailed Excel report with two sheets:
        - Studies with datasets but no images
        - Studies without datasets
+    `file_listings` are looked up when not given (e.g. when they were already fetched by report shards).
+    The file is written row by row unless REPORT_WRITER is "pandas".
     """
     logging.info(f"Generating detailed report file {output}")
+    if file_listings is None:
+        file_listings = get_report_file_listings(accession_lookup, report)
+    if get_settings().report_writer == "pandas":
+        return write_detailed_report_with_pandas(accession_lookup, report, conversion_report, output, file_listings)
+    return write_detailed_report_streaming(accession_lookup, report, conversion_report, output, file_listings)
+
+
+def write_detailed_report_streaming(
+    accession_lookup: dict[str, StudyRecord],
+    report: dict[str, Any],
+    conversion_report:  dict[str, Any],
+    output: Path,
+    file_listings: dict[str, FileListing],
+) -> tuple[Path, dict]:
+    """Same sheets as `write_detailed_report_with_pandas`, written one row at a time without building DataFrames."""
+    from bia_study_tracker.utils.excel_writer import StreamingSheet, open_workbook
+
+    conversion_accessions = sorted(conversion_report)
+    # Summary of the conversion warnings, in order of first appearance as on the pandas sheet
+    key_counts = Counter(k for acc in conversion_accessions
+                         if isinstance(warnings := conversion_report[acc].get("warnings"), dict)
+                         for k in warnings)
+    summary = dict(report["summary_stats"])
+    summary.update({f"Studies in BIA with {key.replace('_', ' ')}": count for key, count in key_counts.items()})
+    # Columns of the conversion report entries, in order of first appearance
+    conversion_cols = list(dict.fromkeys(key for acc in conversion_accessions for key in conversion_report[acc]))
+
+    workbook = open_workbook(output)
+    header_format = workbook.add_format({"bold": True})
+    sheets = [
+        ("summary_stats", report["summary_cols"], summary.items()),
+        ("no_images", DETAILED_SHEET_COLS, (generate_row_for_df(acc, accession_lookup, file_listings)
+                                            for acc in sorted(report["image"]["studies_without"]))),
+        ("no_datasets", DETAILED_SHEET_COLS, (generate_row_for_df(acc, accession_lookup, file_listings)
+                                              for acc in sorted(report["dataset"]["studies_without"]))),
+        ("conversion_report", ["accession_id", *conversion_cols],
+         ([acc, *(conversion_report[acc].get(col) for col in conversion_cols)] for acc in conversion_accessions)),
+    ]
+    for sheet, columns, rows in sheets:
+        writer = StreamingSheet(workbook, sheet, columns, header_format)
+        writer.write_rows(rows)
+        writer.close()
+        logger.info(f"Added sheet {sheet} to the detailed report file {output}")
+    workbook.close()
+    return output, summary
+
+
+def write_detailed_report_with_pandas(
+    accession_lookup: dict[str, StudyRecord],
+    report: dict[str, Any],
+    conversion_report:  dict[str, Any],
+    output: Path,
+    file_listings: dict[str, FileListing],
+) -> tuple[Path, dict]:
+    import pandas as pd
+
     # Sheet 1: Summary sheet
     df_summary = pd.DataFrame.from_dict(report["summary_stats"], orient="index") \
                   .reset_index() \
                   .rename(columns={"index": report["summary_cols"][0], 0: report["summary_cols"][1]})
 
-    sheets_cols = ["accession_id", "alpha_url", "original_study_url", "uuid", "dataset_url", "title",
-        "release_date", "n_files_biostudies", "file_format_biostudies (first 5 files)"]
-    accession_lookup = {d["accession_id"]: d for d in studies_in_bia}
     # Sheet 2: studies with datasets but no images
-    no_img_data = generate_object_for_df(report["image"]["studies_without"], accession_lookup)
-    df_no_images = pd.DataFrame(no_img_data, columns=sheets_cols).sort_values("accession_id")
+    no_img_data = generate_object_for_df(report["image"]["studies_without"], accession_lookup, file_listings)
+    df_no_images = pd.DataFrame(no_img_data, columns=DETAILED_SHEET_COLS).sort_values("accession_id")
 
     # Sheet 3: studies without datasets
-    no_ds_data = generate_object_for_df(report["dataset"]["studies_without"], accession_lookup)
-    df_no_datasets = pd.DataFrame(no_ds_data, columns=sheets_cols).sort_values("accession_id")
+    no_ds_data = generate_object_for_df(report["dataset"]["studies_without"], accession_lookup, file_listings)
+    df_no_datasets = pd.DataFrame(no_ds_data, columns=DETAILED_SHEET_COLS).sort_values("accession_id")
 
     # Sheet 4: Conversion report
     df_conversion_report = pd.DataFrame.from_dict(conversion_report, orient="index")\
@@ -281,18 +401,3 @@ def generate_detailed_report_file(
             logger.info(f"Added sheet {sheet} to the detailed report file {output}")
 
     return output, dict(zip(df_summary['Statistic'], df_summary['Value']))
-
-
-def compare_mongo_elastic_study_list(studies_in_bia: list[dict[str, Any]], studies_in_mongo: list[dict[str, Any]]):
-    report = "*API Sync report*\n"
-    logger.info("Checking mongo elastic sync.")
-    search_accession_ids = set([study['accession_id'] for study in studies_in_bia])
-    mongo_accession_ids = set([study["accession_id"] for study in studies_in_mongo])
-    if len(search_accession_ids) < len(mongo_accession_ids):
-        report += f"`:magnifying_glass: Search API has {len(search_accession_ids)} studies but mongo has {len(mongo_accession_ids)} studies. :eyes:"
-    elif len(mongo_accession_ids) == len(search_accession_ids):
-        report += f":white_tick: Search and Mongo have equal studies. :catjam:"
-    else:
-        report += ":warning: Something doesnt add up. Search has more studies than in Mongo. :warning:"
-    logger.info(report)
-    return report
\ No newline at end of file
@@ -0,0 +1,133 @@
+"""
+Sharded report generation.
+
+`generate-report --shard i/n` runs the report pipeline on a deterministic partition of the accessions and writes a
+`ShardResult` file instead of the Excel report. `merge-reports` combines the results of all n shards into the same
+report as an unsharded run.
+"""
+
+import hashlib
+import json
+import logging
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Iterable, Optional
+from bia_study_tracker.utils.biostudies import FileListing
+from bia_study_tracker.utils.conversion_cache import ConversionDelta
+from bia_study_tracker.utils.records import StudyRecord
+from bia_study_tracker.utils.reports import BIAReport, Statistics
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Shard:
+    index: int
+    count: int
+
+    @classmethod
+    def parse(cls, value: str) -> "Shard":
+        """Parse "i/n" (1 <= i <= n)."""
+        try:
+            index, count = (int(part) for part in value.split("/"))
+        except ValueError:
+            raise ValueError(f"Shard must look like i/n, e.g. 2/4, got {value!r}")
+        if not 1 <= index <= count:
+            raise ValueError(f"Shard index must be between 1 and {count}, got {index}")
+        return cls(index, count)
+
+    def __contains__(self, accession_id: str) -> bool:
+        # A stable hash, unlike hash(), so every runner agrees on the partition
+        digest = hashlib.blake2b(accession_id.encode(), digest_size=8).digest()
+        return int.from_bytes(digest) % self.count == self.index - 1
+
+    def __str__(self) -> str:
+        return f"{self.index}/{self.count}"
+
+    @property
+    def filename(self) -> str:
+        return f"shard-{self.index}-of-{self.count}.json"
+
+
+@dataclass
+class ShardResult:
+    shard: Shard
+    report: BIAReport
+    conversion_report: dict[str, Any]
+    # studies without images or datasets, for the detailed report sheets
+    accession_lookup: dict[str, StudyRecord]
+    file_listings: dict[str, FileListing]
+    conversion_delta: Optional[ConversionDelta] = None
+
+    def write(self, path: Path) -> Path:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps({
+            "shard": asdict(self.shard),
+            "report": self.report.to_dict(),
+            "conversion_report": self.conversion_report,
+            "accession_lookup": {acc: study.to_dict() for acc, study in self.accession_lookup.items()},
+            "file_listings": {acc: asdict(listing) for acc, listing in self.file_listings.items()},
+            "conversion_delta": asdict(self.conversion_delta) if self.conversion_delta else None,
+        }))
+        logger.info(f"Shard {self.shard} result saved to {path}")
+        return path
+
+    @classmethod
+    def read(cls, path: Path) -> "ShardResult":
+        data = json.loads(path.read_text())
+        return cls(
+            shard=Shard(**data["shard"]),
+            report=BIAReport.from_dict(data["report"]),
+            conversion_report=data["conversion_report"],
+            accession_lookup={acc: StudyRecord.from_dict(study) for acc, study in data["accession_lookup"].items()},
+            file_listings={acc: FileListing(**listing) for acc, listing in data["file_listings"].items()},
+            conversion_delta=ConversionDelta(**data["conversion_delta"]) if data.get("conversion_delta") else None,
+        )
+
+
+def find_shard_results(paths: Iterable[Path]) -> list[Path]:
+    """The given shard result files, with directories expanded to the shard files they contain."""
+    return [found for path in paths for found in (sorted(path.glob("shard-*-of-*.json")) if path.is_dir() else [path])]
+
+
+def merge_shard_results(results: list[ShardResult]) -> ShardResult:
+    """Combine the results of every shard of one run. Raises ValueError if shards are missing or repeated."""
+    if not results:
+        raise ValueError("No shard results to merge")
+    counts = {result.shard.count for result in results}
+    if len(counts) > 1:
+        raise ValueError(f"Shard results come from runs with different shard counts: {sorted(counts)}")
+    count = counts.pop()
+    indexes = sorted(result.shard.index for result in results)
+    if indexes != list(range(1, count + 1)):
+        missing = sorted(set(range(1, count + 1)) - set(indexes))
+        repeated = sorted({index for index in indexes if indexes.count(index) > 1})
+        raise ValueError(f"Incomplete set of {count} shards: missing {missing}, repeated {repeated}")
+
+    def merge_statistics(name: str) -> Statistics:
+        return Statistics(
+            [acc for result in results for acc in getattr(result.report, name).studies_with],
+            [acc for result in results for acc in getattr(result.report, name).studies_without],
+        )
+
+    results = sorted(results, key=lambda result: result.shard.index)
+    report = BIAReport(
+        total_studies=sum(result.report.total_studies for result in results),
+        image=merge_statistics("image"),
+        dataset=merge_statistics("dataset"),
+        biostudies=merge_statistics("biostudies"),
+    )
+    deltas = [result.conversion_delta for result in results]
+    conversion_delta = ConversionDelta(
+        new=sorted(acc for delta in deltas for acc in delta.new),
+        updated=sorted(acc for delta in deltas for acc in delta.updated),
+        removed=sorted(acc for delta in deltas for acc in delta.removed),
+    ) if all(deltas) else None
+    return ShardResult(
+        shard=Shard(1, 1),
+        report=report,
+        conversion_report={acc: entry for result in results for acc, entry in result.conversion_report.items()},
+        accession_lookup={acc: study for result in results for acc, study in result.accession_lookup.items()},
+        file_listings={acc: listing for result in results for acc, listing in result.file_listings.items()},
+        conversion_delta=conversion_delta,
+    )
@@ -6,6 +6,7 @@ from slack_sdk.errors import SlackApiError
 from typing import Any
 from prettytable import PrettyTable
 from bia_study_tracker.settings import get_settings
+from bia_study_tracker.utils.metrics import format_performance_table, get_metrics, timed
 
 logger = logging.getLogger(__name__)
 
@@ -13,24 +14,62 @@ logger = logging.getLogger(__name__)
 def build_message(data: Any) -> str:
     return f"*BIA-study-tracker-report - {datetime.now().strftime("%d %b %Y - %H:%M")}*\n```{data}```"
 
-def format_slack_message(stats: dict[str, Any], cols) -> str:
+def format_slack_message(stats: dict[str, Any], cols, trend: dict[str, Any] | None = None) -> str:
+    """The summary table, with the change of each statistic since the previous run when there is a `trend`."""
+    if trend:
+        cols = [*cols, f"Change since {format_previous_run(trend)}"]
     table = PrettyTable(cols)
     table.align = "l"
     for key, value in stats.items():
-        table.add_row([key, value])
+        if trend:
+            change = trend["changes"].get(key)
+            table.add_row([key, value, f"{change['change']:+d}" if change else ""])
+        else:
+            table.add_row([key, value])
     return table.get_formatted_string()
 
+def format_accessions(label: str, accessions: list[str], limit: int = 10) -> str:
+    """The number of accessions after `label`, followed by the first `limit` of them."""
+    more = f" and {len(accessions) - limit} more" if len(accessions) > limit else ""
+    return f"{label}: {len(accessions)}" + (f" ({', '.join(accessions[:limit])}{more})" if accessions else "")
+
+def format_conversion_delta(delta: dict[str, list[str]], limit: int = 10) -> str:
+    """One line per kind of change, listing at most `limit` accessions."""
+    return "\n".join(format_accessions(change.capitalize(), delta.get(change, []), limit)
+                     for change in ("new", "updated", "removed"))
+
+def format_previous_run(trend: dict[str, Any]) -> str:
+    return datetime.fromisoformat(trend["previous_run_at"]).strftime("%d %b %Y")
+
+def format_trend(trend: dict[str, Any], limit: int = 10) -> str:
+    """Ingestion throughput and regressed studies since the previous run, empty when there are neither."""
+    lines = []
+    if trend["studies_per_week"] is not None:
+        lines.append(f"Ingestion: {trend['studies_per_week']:+.1f} studies/week since {format_previous_run(trend)}, "
+                     f"{trend['mean_studies_per_week']:+.1f} on average over {trend['n_runs']} runs")
+    lines.extend(format_accessions(f"Regressed, {label}", accessions, limit)
+                 for label, accessions in trend["regressions"].items())
+    return "\n".join(lines)
+
 class SlackReportBot:
     def __init__(self) -> None:
         settings = get_settings()
         # Get Slack token from environment variable
         self.slack_token = settings.slack_bot_token
         self.slack_channel = settings.slack_channel
+        self.performance_table = settings.slack_performance_table
         if self.slack_token is None or self.slack_channel is None:
             logger.error("SLACK_BOT_TOKEN or SLACK_BOT_CHANNEL not set")
         ssl_ctx = ssl.create_default_context(cafile=certifi.where())
         self.client = WebClient(token=self.slack_token, ssl=ssl_ctx)
 
+    def add_performance_table(self, message: str) -> str:
+        """Append the run performance table to the message when SLACK_PERFORMANCE_TABLE is on."""
+        if not self.performance_table:
+            return message
+        return f"{message}\n*Run performance*\n```{format_performance_table(get_metrics().to_dict())}```"
+
+    @timed("slack")
     def send_message(self, message: str) -> bool:
         try:
             self.client.chat_postMessage(channel=self.slack_channel, text=message, mrkdwn=True)
@@ -40,6 +79,7 @@ class SlackReportBot:
             logger.error(f"Slack API error: {e.response['error']}")
             return False
 
+    @timed("slack")
     def upload_file(self, file_path: str, message: str = "") -> bool:
         try:
             resp = self.client.files_upload_v2(channel=self.slack_channel, initial_comment=message, file=file_path)
@@ -50,6 +90,12 @@ class SlackReportBot:
             return False
 
     def run(self, data: Any, file_path: str | None = None) -> bool:
-        msg = format_slack_message(data["summary_stats"], data["summary_cols"])
+        msg = format_slack_message(data["summary_stats"], data["summary_cols"], data.get("trend"))
         msg = build_message(msg)
+        if data.get("trend") and (trend := format_trend(data["trend"])):
+            msg += f"\n*Trend*\n```{trend}```"
+        # The delta is always there once the conversion cache ran, post it only when an entry changed
+        if any((data.get("conversion_delta") or {}).values()):
+            msg += f"\n*Conversion report changes since the last run*\n```{format_conversion_delta(data['conversion_delta'])}```"
+        msg = self.add_performance_table(msg)
         return self.upload_file(file_path, msg) if file_path else self.send_message(msg)
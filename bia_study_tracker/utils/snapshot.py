@@ -0,0 +1,90 @@
+"""
+On-disk store of documents kept between runs, e.g. the conversion report entries and the BioStudies study list,
+each with a content hash to tell which of them changed.
+"""
+
+import hashlib
+import json
+import logging
+import sqlite3
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def content_hash(document: Any) -> str:
+    return hashlib.sha1(json.dumps(document, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class SnapshotStore:
+    """SQLite key/value store of documents grouped by kind (e.g. "conversion_full", "study"), each with a content hash."""
+
+    def __init__(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS documents (
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                body TEXT NOT NULL,
+                PRIMARY KEY (kind, key)
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            """
+        )
+
+    def load(self, kind: str) -> dict[str, Any]:
+        rows = self.connection.execute("SELECT key, body FROM documents WHERE kind = ?", (kind,))
+        return {key: json.loads(body) for key, body in rows}
+
+    def get(self, kind: str, key: str) -> Optional[Any]:
+        row = self.connection.execute("SELECT body FROM documents WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def hashes(self, kind: str) -> dict[str, str]:
+        rows = self.connection.execute("SELECT key, hash FROM documents WHERE kind = ?", (kind,))
+        return dict(rows.fetchall())
+
+    def upsert(self, kind: str, documents: dict[str, Any], hashes: Optional[dict[str, str]] = None) -> None:
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO documents (kind, key, hash, body) VALUES (?, ?, ?, ?)",
+                (
+                    (kind, key, hashes[key] if hashes else content_hash(body), json.dumps(body, default=str))
+                    for key, body in documents.items()
+                ),
+            )
+
+    def delete(self, kind: str, keys: Iterable[str]) -> None:
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM documents WHERE kind = ? AND key = ?", ((kind, key) for key in keys)
+            )
+
+    def replace(self, kind: str, documents: dict[str, Any], hashes: Optional[dict[str, str]] = None) -> None:
+        with self.connection:
+            self.connection.execute("DELETE FROM documents WHERE kind = ?", (kind,))
+        self.upsert(kind, documents, hashes)
+        self.set_refreshed(kind)
+
+    def set_refreshed(self, kind: str) -> None:
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                (f"{kind}_refreshed_at", datetime.now(timezone.utc).isoformat()),
+            )
+
+    def refreshed_at(self, kind: str) -> Optional[datetime]:
+        row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (f"{kind}_refreshed_at",)).fetchone()
+        return datetime.fromisoformat(row[0]) if row else None
+
+    def close(self) -> None:
+        self.connection.close()
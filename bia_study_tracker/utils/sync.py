@@ -0,0 +1,104 @@
+"""
+Reconciliation of the studies in the search index against the studies in Mongo.
+"""
+
+import hashlib
+import logging
+from dataclasses import dataclass, field
+from typing import Iterable
+from bia_study_tracker.utils.records import StudyRecord
+
+logger = logging.getLogger(__name__)
+
+SYNC_FIELDS = ["uuid", "title", "release_date", "version"]
+MAX_LISTED = 20
+
+
+def _sync_values(study: StudyRecord) -> tuple[str, ...]:
+    # Dates are compared at day resolution as the two APIs don't serialise datetimes the same way. The version
+    # catches a study updated in Mongo but not re-indexed, in fields that aren't compared
+    return study.uuid, study.title.strip(), study.release_date[:10], str(study.version)
+
+
+def _values_hash(values: tuple[str, ...]) -> str:
+    return hashlib.blake2b("\x1f".join(values).encode(), digest_size=8).hexdigest()
+
+
+@dataclass
+class StudyIndex:
+    """accession -> (content hash, synced field values), built from a stream of study records."""
+    entries: dict[str, tuple[str, tuple[str, ...]]] = field(default_factory=dict)
+    duplicates: set[str] = field(default_factory=set)
+
+    @classmethod
+    def from_records(cls, studies: Iterable[StudyRecord]) -> "StudyIndex":
+        index = cls()
+        for study in studies:
+            if study.accession_id in index.entries:
+                index.duplicates.add(study.accession_id)
+            values = _sync_values(study)
+            index.entries[study.accession_id] = (_values_hash(values), values)
+        return index
+
+
+@dataclass
+class SyncReport:
+    n_search: int
+    n_mongo: int
+    missing_in_search: list[str]
+    missing_in_mongo: list[str]
+    # accession -> names of the fields that differ
+    drift: dict[str, list[str]]
+    duplicates_in_search: list[str]
+    duplicates_in_mongo: list[str]
+
+    @property
+    def in_sync(self) -> bool:
+        return not (self.missing_in_search or self.missing_in_mongo or self.drift
+                    or self.duplicates_in_search or self.duplicates_in_mongo)
+
+
+def reconcile_studies(search_index: StudyIndex, mongo_index: StudyIndex) -> SyncReport:
+    drift = {}
+    for accession_id, (mongo_hash, mongo_values) in mongo_index.entries.items():
+        search_entry = search_index.entries.get(accession_id)
+        if search_entry and search_entry[0] != mongo_hash:
+            drift[accession_id] = [
+                name for name, search_value, mongo_value in zip(SYNC_FIELDS, search_entry[1], mongo_values)
+                if search_value != mongo_value
+            ]
+    return SyncReport(
+        n_search=len(search_index.entries),
+        n_mongo=len(mongo_index.entries),
+        missing_in_search=sorted(mongo_index.entries.keys() - search_index.entries.keys()),
+        missing_in_mongo=sorted(search_index.entries.keys() - mongo_index.entries.keys()),
+        drift=dict(sorted(drift.items())),
+        duplicates_in_search=sorted(search_index.duplicates),
+        duplicates_in_mongo=sorted(mongo_index.duplicates),
+    )
+
+
+def _list_accessions(accessions: list[str]) -> str:
+    listed = ", ".join(accessions[:MAX_LISTED])
+    return listed + (f" ... (+{len(accessions) - MAX_LISTED} more)" if len(accessions) > MAX_LISTED else "")
+
+
+def format_sync_report(report: SyncReport) -> str:
+    message = "*API Sync report*\n"
+    message += f"Search API has {report.n_search} studies and Mongo has {report.n_mongo} studies.\n"
+    if report.in_sync:
+        return message + ":white_tick: Search and Mongo have the same studies with the same content. :catjam:"
+    if report.missing_in_search:
+        message += f":magnifying_glass: {len(report.missing_in_search)} studies in Mongo but not in Search: " \
+                   f"`{_list_accessions(report.missing_in_search)}`\n"
+    if report.missing_in_mongo:
+        message += f":warning: {len(report.missing_in_mongo)} studies in Search but not in Mongo: " \
+                   f"`{_list_accessions(report.missing_in_mongo)}`\n"
+    if report.drift:
+        drifted = [f"{acc} ({', '.join(fields)})" for acc, fields in report.drift.items()]
+        message += f":eyes: {len(report.drift)} studies differ between Search and Mongo: `{_list_accessions(drifted)}`\n"
+    for side, duplicates in [("Search", report.duplicates_in_search), ("Mongo", report.duplicates_in_mongo)]:
+        if duplicates:
+            message += f":warning: {len(duplicates)} accessions appear more than once in {side}: " \
+                       f"`{_list_accessions(duplicates)}`\n"
+    return message.rstrip("\n")
@@ -0,0 +1,225 @@
+"""
+Parallel OME-Zarr validation with a persistent result cache.
+
+Validation tiers:
+  - metadata: check the root metadata and multiscales structure over HTTP, without opening any array
+  - sampled: full validation of a deterministic sample of representations, metadata tier for the rest
+  - full: ngff_zarr validation of every representation
+"""
+
+import logging
+import multiprocessing
+import signal
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Iterable, Optional
+import requests
+from bia_study_tracker.settings import get_settings
+from bia_study_tracker.utils.API_client import get_session
+from bia_study_tracker.utils.metrics import get_metrics
+from bia_study_tracker.utils.snapshot import SnapshotStore
+
+if TYPE_CHECKING:
+    from bia_study_tracker.utils.checkpoint import RunCheckpoint
+
+logger = logging.getLogger(__name__)
+
+ZARR_METADATA_FILES = ["zarr.json", ".zattrs"]
+VALIDATION_TIERS = ["metadata", "sampled", "full"]
+
+
+@dataclass
+class ValidationResult:
+    file_uri: str
+    valid: bool
+    error: str = ""
+    timed_out: bool = False
+    tier: str = "full"
+    seconds: float = 0.0
+    # The worker process died during the validation, e.g. out of memory
+    crashed: bool = False
+
+
+def get_staleness_marker(file_uri: str) -> str:
+    """ETag / Last-Modified of the zarr's root metadata file, or "" when it can't be determined."""
+    for name in ZARR_METADATA_FILES:
+        try:
+            response = get_session().head(f"{file_uri.rstrip('/')}/{name}", timeout=30, allow_redirects=True)
+        except requests.exceptions.RequestException:
+            continue
+        if response.status_code == 200:
+            return response.headers.get("ETag") or response.headers.get("Last-Modified", "")
+    return ""
+
+
+def _read_root_metadata(base_uri: str, timeout: float) -> tuple[dict, str]:
+    """Return the OME attributes of a zarr and the name of its array metadata file (v3 or v2 layout)."""
+    response = get_session().get(f"{base_uri}/zarr.json", timeout=timeout)
+    if response.status_code == 200:
+        return response.json().get("attributes", {}).get("ome", {}), "zarr.json"
+    response = get_session().get(f"{base_uri}/.zattrs", timeout=timeout)
+    response.raise_for_status()
+    return response.json(), ".zarray"
+
+
+def validate_zarr_metadata(file_uri: str, timeout: float) -> ValidationResult:
+    """Check the multiscales metadata and that every listed scale has array metadata, without reading chunks."""
+    base_uri = file_uri.rstrip("/")
+    start = time.perf_counter()
+    try:
+        attributes, array_metadata_file = _read_root_metadata(base_uri, timeout)
+        multiscales = attributes.get("multiscales")
+        if not multiscales:
+            raise ValueError("No multiscales metadata")
+        for multiscale in multiscales:
+            datasets = multiscale.get("datasets")
+            if not datasets:
+                raise ValueError("Multiscales metadata has no datasets")
+            for dataset in datasets:
+                if "path" not in dataset:
+                    raise ValueError("Multiscales dataset has no path")
+                array_uri = f"{base_uri}/{dataset['path']}/{array_metadata_file}"
+                if get_session().head(array_uri, timeout=timeout, allow_redirects=True).status_code != 200:
+                    raise ValueError(f"Missing array metadata {dataset['path']}/{array_metadata_file}")
+        return ValidationResult(file_uri, True, tier="metadata", seconds=time.perf_counter() - start)
+    except (requests.exceptions.RequestException, ValueError, AttributeError) as e:
+        return ValidationResult(file_uri, False, repr(e), tier="metadata", seconds=time.perf_counter() - start)
+
+
+def _raise_timeout(signum, frame):
+    raise TimeoutError("Validation timed out")
+
+
+def validate_zarr(file_uri: str, timeout: float) -> ValidationResult:
+    """Fully validate one OME-Zarr. Runs in a worker process so SIGALRM can interrupt a hung read."""
+    from ngff_zarr import from_ngff_zarr
+
+    signal.signal(signal.SIGALRM, _raise_timeout)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    start = time.perf_counter()
+    try:
+        from_ngff_zarr(file_uri, validate=True)
+        return ValidationResult(file_uri, True, seconds=time.perf_counter() - start)
+    except TimeoutError as e:
+        return ValidationResult(file_uri, False, repr(e), timed_out=True, seconds=time.perf_counter() - start)
+    except Exception as e:
+        return ValidationResult(file_uri, False, repr(e), seconds=time.perf_counter() - start)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+class ZarrValidator:
+    def __init__(self, workers: Optional[int] = None, timeout: Optional[float] = None) -> None:
+        settings = get_settings()
+        self.workers = workers or settings.validation_workers
+        self.timeout = timeout or settings.validation_timeout
+        self.marker_workers = settings.max_concurrent_requests
+        self.max_age = timedelta(days=settings.validation_cache_max_age_days)
+        self.cache = SnapshotStore(Path(settings.cache_dir) / "zarr_validation.sqlite")
+
+    def _split_cached(self, file_uris: list[str], tier: str) -> tuple[dict[str, ValidationResult], dict[str, str]]:
+        """Return the cached results that are still fresh, and the staleness markers of the uris to validate.
+        A result is only reused with a non-empty marker: without one a change of the zarr can't be detected."""
+        with ThreadPoolExecutor(max_workers=self.marker_workers) as executor:
+            markers = dict(zip(file_uris, executor.map(get_staleness_marker, file_uris)))
+        cached = self.cache.load(f"zarr_{tier}")
+        cached_markers = self.cache.hashes(f"zarr_{tier}")
+        now = datetime.now(timezone.utc)
+        fresh, to_validate = {}, {}
+        for uri, marker in markers.items():
+            entry = cached.get(uri)
+            if entry and marker and cached_markers[uri] == marker and now - datetime.fromisoformat(entry["validated_at"]) < self.max_age:
+                fresh[uri] = ValidationResult(uri, entry["valid"], entry["error"], tier=tier)
+            else:
+                to_validate[uri] = marker
+        return fresh, to_validate
+
+    def cached_results(self, file_uris: Iterable[str], tier: str) -> dict[str, ValidationResult]:
+        """The cached results of the uris that aren't older than VALIDATION_CACHE_MAX_AGE_DAYS, without checking
+        whether the zarrs changed since."""
+        cached = self.cache.load(f"zarr_{tier}")
+        now = datetime.now(timezone.utc)
+        return {uri: ValidationResult(uri, entry["valid"], entry["error"], tier=tier)
+                for uri in file_uris if (entry := cached.get(uri))
+                and now - datetime.fromisoformat(entry["validated_at"]) < self.max_age}
+
+    def _executor(self, tier: str) -> tuple[Executor, Callable[[str, float], ValidationResult], int]:
+        """A new executor for the tier, its validation function and its number of workers."""
+        if tier == "metadata":
+            return ThreadPoolExecutor(max_workers=self.marker_workers), validate_zarr_metadata, self.marker_workers
+        # Workers are started from a fork server: forking this process would copy the locks held by the
+        # prefetch, HTTP pool and SQLite threads still running in it, and could deadlock the workers
+        executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("forkserver"))
+        return executor, validate_zarr, self.workers
+
+    def validate(self, file_uris: Iterable[str], tier: str = "full",
+                 checkpoint: Optional["RunCheckpoint"] = None) -> dict[str, ValidationResult]:
+        """Validate the uris with the "metadata" or "full" tier, reusing unchanged cached results.
+        With a `checkpoint`, outcomes saved by an interrupted run (timeouts included) are reused as they are,
+        and each new outcome is saved as soon as it is known."""
+        file_uris = set(file_uris)
+        checkpointed = {}
+        if checkpoint:
+            checkpointed = {uri: ValidationResult(**result) for uri, result in checkpoint.load(f"validation_{tier}").items()
+                            if uri in file_uris}
+            logger.info(f"Reusing {len(checkpointed)} {tier} validation outcomes from the run checkpoint")
+        results, to_validate = self._split_cached(list(file_uris - checkpointed.keys()), tier)
+        logger.info(f"Validating {len(to_validate)} zarrs ({tier} tier) "
+                    f"({len(results)} unchanged results reused from cache)")
+        get_metrics().record_cached_validations(tier, len(results))
+        executor, validate, n_workers = self._executor(tier)
+        pending = deque(to_validate)
+        # Only as many validations as workers are submitted at a time, so a worker dying only fails those
+        in_flight: dict[Future, str] = {}
+        try:
+            while pending or in_flight:
+                broken = False
+                while pending and len(in_flight) < n_workers and not broken:
+                    try:
+                        in_flight[executor.submit(validate, pending[0], self.timeout)] = pending[0]
+                        pending.popleft()
+                    except BrokenProcessPool:
+                        broken = True
+                # Outcomes are recorded as they complete, so an interrupted run keeps everything validated so far
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                if broken or any(isinstance(future.exception(), BrokenProcessPool) for future in done):
+                    # A dead worker (e.g. out of memory in ngff_zarr) breaks the whole pool, failing every
+                    # validation in flight. They are recorded as failed, so that --resume doesn't retry them
+                    logger.error(f"A {tier} validation worker died, failing the validations still in flight "
+                                 "and starting new workers")
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    done, _ = wait(in_flight)
+                    executor, validate, n_workers = self._executor(tier)
+                for future in done:
+                    uri = in_flight.pop(future)
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool as e:
+                        result = ValidationResult(uri, False, f"Validation worker died: {e!r}", tier=tier, crashed=True)
+                    results[uri] = result
+                    self._record(result, tier, to_validate[uri], checkpoint)
+        finally:
+            # On an interruption, don't wait for the validations in flight, only to discard them
+            executor.shutdown(wait=not in_flight, cancel_futures=True)
+        return checkpointed | results
+
+    def _record(self, result: ValidationResult, tier: str, marker: str, checkpoint: Optional["RunCheckpoint"]) -> None:
+        get_metrics().record_validation(tier, result.seconds, result.timed_out)
+        if checkpoint:
+            checkpoint.save(f"validation_{tier}", {result.file_uri: asdict(result)})
+        if result.timed_out:
+            logger.warning(f"Validation of {result.file_uri} timed out after {self.timeout}s")
+        # A timeout or a crash may not happen again, so the zarr is validated again by the next run
+        if result.timed_out or result.crashed:
+            return
+        self.cache.upsert(
+            f"zarr_{tier}",
+            {result.file_uri: {"valid": result.valid, "error": result.error,
+                               "validated_at": datetime.now(timezone.utc).isoformat()}},
+            {result.file_uri: marker},
+        )